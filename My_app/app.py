@@ -1,445 +1,3639 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 from datetime import datetime, timedelta
 import hashlib
+import hmac
 import secrets
+import zlib
 import time
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
+import random
+import bisect
+from flask import (Flask, Response, abort, request, jsonify, render_template, redirect, url_for, session, g,
+                   has_request_context, send_from_directory)
+from flask.signals import before_render_template, template_rendered
+from flask.sessions import SessionInterface, SecureCookieSession, SecureCookieSessionInterface
+from flask.json.tag import TaggedJSONSerializer
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+import click
 from flask_session import Session
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-from PIL import Image
-import io
+from werkzeug.middleware.proxy_fix import ProxyFix
+import imaging
+import migrations
+import logging_config
+import assets
+import mimetypes
+import json
+import re
+import queue
 import logging
+import threading
+import functools
+import inspect
+import sys
+import math
+import copy
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import multiprocessing
+from collections import OrderedDict, Counter
 import psycopg2
 from psycopg2 import sql, errors
 from urllib.parse import urlparse
 import sqlite3
 
+def gevent_patched():
+    """True when gevent has monkey-patched this process, as gunicorn's gevent worker does"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+def gevent_wait_callback(conn, timeout=None):
+    """Let psycopg2 yield to other greenlets while it waits on the server"""
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+
+# Under gevent every request is a greenlet: sockets, locks and sleeps are
+# cooperative, and psycopg2 is made so here. CPU-bound work goes to native threads.
+COOPERATIVE = gevent_patched()
+if COOPERATIVE:
+    psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+def native_executor(max_workers, thread_name_prefix):
+    """Thread pool for CPU-bound work; real OS threads even when threading is patched"""
+    if COOPERATIVE:
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ['FLASK_SECRET_KEY']  # No fallback!
-app.config['SESSION_TYPE'] = 'filesystem'
+app.config['SESSION_BACKEND'] = os.getenv('SESSION_BACKEND', 'cookie')  # cookie, database or filesystem
+app.config['SESSION_TYPE'] = 'filesystem'  # Only used by the filesystem backend
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(seconds=int(os.getenv('SESSION_LIFETIME', 7 * 24 * 3600)))
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['ASSET_BUILD'] = os.getenv('ASSET_BUILD', 'true').lower() == 'true'  # Fingerprint static assets at startup; false if `python assets.py` ran at deploy
+app.config['ARCHIVE_FOLDER'] = os.getenv('ARCHIVE_FOLDER', 'archive')  # Cold tier for old answers; see archive-responses
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB upload limit
+app.config['DEEPSEEK_API_URL'] = os.getenv('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1/chat/completions')
+app.config['AI_WORKERS'] = int(os.getenv('AI_WORKERS', 200 if COOPERATIVE else 8))  # Answer jobs run at once per gunicorn worker; see AI_MAX_IN_FLIGHT
+app.config['AI_MAX_PENDING'] = int(os.getenv('AI_MAX_PENDING', 1000 if COOPERATIVE else 50))  # Queued + running jobs before /ask refuses
+app.config['AI_MAX_IN_FLIGHT'] = int(os.getenv('AI_MAX_IN_FLIGHT', 4))  # Concurrent DeepSeek calls per gunicorn worker; 0 for no cap
+app.config['AI_SLOT_TIMEOUT'] = float(os.getenv('AI_SLOT_TIMEOUT', 20))  # Seconds a job waits for a call slot before failing
+app.config['AI_STREAMING'] = os.getenv('AI_STREAMING', 'true').lower() == 'true'  # Relay tokens to the browser as they arrive
+app.config['LONG_POLL'] = COOPERATIVE or int(os.getenv('GUNICORN_THREADS', 1)) > 1  # Hold payment polls and answer streams open only if the worker has other threads or greenlets to serve with
+app.config['AI_STREAM_TIMEOUT'] = int(os.getenv('AI_STREAM_TIMEOUT', 25))  # Seconds an SSE relay holds a worker before the client falls back to polling
+app.config['AI_MAX_TOKENS'] = int(os.getenv('AI_MAX_TOKENS', 1000))  # Upper bound on the answer budget the planner picks
+app.config['AI_MAX_PROMPT_TOKENS'] = int(os.getenv('AI_MAX_PROMPT_TOKENS', 1500))  # Typed questions are trimmed past this estimate
+app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))  # Image processes per gunicorn worker; 0 processes in-thread
+app.config['HTTP_POOL_SIZE'] = int(os.getenv('HTTP_POOL_SIZE', 10))  # Keep-alive connections per upstream host
+app.config['HTTP_RETRIES'] = int(os.getenv('HTTP_RETRIES', 2))
+app.config['HTTP_BACKOFF'] = float(os.getenv('HTTP_BACKOFF', 0.5))  # Base seconds for jittered backoff
+app.config['CIRCUIT_FAILURE_THRESHOLD'] = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+app.config['CIRCUIT_RESET_TIMEOUT'] = int(os.getenv('CIRCUIT_RESET_TIMEOUT', 30))  # Seconds before probing again
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')  # Werkzeug method string, e.g. scrypt:32768:8:1; changing it rehashes on login
+app.config['HASH_WORKERS'] = int(os.getenv('HASH_WORKERS', 2))  # Concurrent password hashes per gunicorn worker
+app.config['HASH_MAX_PENDING'] = int(os.getenv('HASH_MAX_PENDING', 16))  # Hashes allowed to wait before sign-ins are refused
+app.config['LOGIN_USERNAME_LIMIT'] = int(os.getenv('LOGIN_USERNAME_LIMIT', 5))  # Attempts per username per period
+app.config['LOGIN_IP_LIMIT'] = int(os.getenv('LOGIN_IP_LIMIT', 20))  # Login/register attempts per client IP per period
+app.config['LOGIN_LIMIT_PERIOD'] = int(os.getenv('LOGIN_LIMIT_PERIOD', 300))  # Seconds
+app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', 0))  # X-Forwarded-For hops to trust for the client IP (1 on Heroku)
+app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'json')  # json lines or text
+app.config['LOG_FILE'] = os.getenv('LOG_FILE', 'app.log')  # Empty for stdout only
+app.config['LOG_MAX_BYTES'] = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))  # Rotate at this size...
+app.config['LOG_ROTATE_WHEN'] = os.getenv('LOG_ROTATE_WHEN')  # ...or on a schedule instead, e.g. midnight
+app.config['LOG_BACKUP_COUNT'] = int(os.getenv('LOG_BACKUP_COUNT', 5))
+app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # Records buffered before new ones are dropped
+app.config['LOG_SAMPLE'] = os.getenv('LOG_SAMPLE', '')  # Share of sub-WARNING records kept per logger, e.g. mpesa.callback=0.1
+# Secret last segment of the callback URL given to M-Pesa; derived from the secret key when unset
+app.config['MPESA_CALLBACK_TOKEN'] = os.getenv('MPESA_CALLBACK_TOKEN') or hmac.new(
+    app.config['SECRET_KEY'].encode(), b'mpesa-callback', 'sha256').hexdigest()
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')  # Bearer token for /metrics; unset disables it
+app.config['ADMIN_TOKEN'] = os.getenv('ADMIN_TOKEN')  # Bearer token for /admin/ endpoints; unset disables them
+app.config['PROFILE_SLOW_REQUESTS'] = float(os.getenv('PROFILE_SLOW_REQUESTS', 0))  # Seconds; dump a flamegraph for slower requests, 0 disables the profiler
+app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', 1.0))  # Share of requests sampled while the profiler is on
+app.config['PROFILE_INTERVAL'] = float(os.getenv('PROFILE_INTERVAL', 0.005))  # Seconds between stack samples
+app.config['DASHBOARD_CACHE_SIZE'] = int(os.getenv('DASHBOARD_CACHE_SIZE', 5000))  # Users per worker
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.getenv('FRAGMENT_CACHE_SIZE', 5000))  # Rendered template fragments per worker
+app.config['TEMPLATE_CACHE_DIR'] = os.getenv('TEMPLATE_CACHE_DIR')  # Compiled template bytecode, shared by workers; defaults to a temp dir
+app.config['ENTITLEMENT_CACHE_SIZE'] = int(os.getenv('ENTITLEMENT_CACHE_SIZE', 10000))  # Users per worker
+app.config['ENTITLEMENT_CACHE_TTL'] = int(os.getenv('ENTITLEMENT_CACHE_TTL', 300))  # Seconds before a cached subscription is re-read regardless
+app.config['ENTITLEMENT_SYNC_INTERVAL'] = float(os.getenv('ENTITLEMENT_SYNC_INTERVAL', 2))  # Seconds between polls for other workers' changes; 0 turns polling off
+app.config['ANSWER_CACHE_SIZE'] = int(os.getenv('ANSWER_CACHE_SIZE', 1000))  # In-memory entries per worker
+app.config['ANSWER_CACHE_TTL'] = int(os.getenv('ANSWER_CACHE_TTL', 7 * 24 * 3600))  # Seconds
+app.config['ANSWER_CACHE_SHARED'] = os.getenv('ANSWER_CACHE_SHARED', 'true').lower() == 'true'
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
+
+# Configure logging: records are queued here and written by a single background thread
+log_handler = logging_config.configure_logging(
+    level=app.config['LOG_LEVEL'],
+    json_lines=app.config['LOG_FORMAT'] == 'json',
+    log_file=app.config['LOG_FILE'],
+    max_bytes=app.config['LOG_MAX_BYTES'],
+    backup_count=app.config['LOG_BACKUP_COUNT'],
+    rotate_when=app.config['LOG_ROTATE_WHEN'],
+    queue_size=app.config['LOG_QUEUE_SIZE'],
+    sample_rates=logging_config.parse_sample_rates(app.config['LOG_SAMPLE']),
+    # The gunicorn master exports SERVER_SOFTWARE to its workers
+    per_process=os.getenv('SERVER_SOFTWARE', '').startswith('gunicorn/')
 )
+callback_log = logging.getLogger('mpesa.callback')
+
+def parse_timestamp(value):
+    """Timestamps come back as datetimes from psycopg2 but as ISO strings from SQLite"""
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+def payment_plan(purpose, plan_type):
+    """The plan a payment counts towards in the usage rollups"""
+    return plan_type or ('monthly' if purpose == 'subscription' else 'pay_per_use')
+
+def question_plan(payment_id):
+    # Questions asked with no payment of their own were covered by a subscription
+    return 'pay_per_use' if payment_id else 'monthly'
+
+def compress_response(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+def decompress_response(data):
+    # psycopg2 returns BYTEA as a memoryview, which zlib takes as is
+    return zlib.decompress(data).decode('utf-8')
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of PostgreSQL connections for one worker process.
 
-# Initialize server-side session
-Session(app)
+    Connections are checked out per call through ``connection()`` and handed
+    back when the block exits, so one request's rollback can never touch
+    another request's transaction. Idle connections are health-checked before
+    reuse and replaced transparently if the server dropped them.
+    """
+
+    def __init__(self, connect, minconn=1, maxconn=10, timeout=30, health_check_interval=30):
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._metrics = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'reconnects': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+        for _ in range(minconn):
+            with self._cond:
+                self._size += 1
+            self._idle.append((self._new_connection(), time.monotonic()))
+
+    def _new_connection(self):
+        """Connect into a slot the caller already counted in _size; gives it back on failure"""
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._metrics['timeouts'] += 1
+                    raise RuntimeError("Database is busy. Please try again.")
+                self._cond.wait(remaining)
+            idle = self._idle.pop() if self._idle else None
+            if idle is None:
+                # Reserve the slot before connecting, so concurrent callers can't overshoot maxconn
+                self._size += 1
+            waited = time.monotonic() - started
+            self._metrics['checkouts'] += 1
+            self._metrics['wait_time_total'] += waited
+            self._metrics['wait_time_max'] = max(self._metrics['wait_time_max'], waited)
+
+        if idle is None:
+            return self._new_connection()
+
+        conn, last_used = idle
+        if self._is_healthy(conn, last_used):
+            return conn
+
+        # Server went away (restart, failover, idle timeout) - reconnect in the same slot
+        logging.warning("Discarding dead database connection and reconnecting")
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._metrics['reconnects'] += 1
+        return self._new_connection()
+
+    def _checkin(self, conn):
+        if conn.closed:
+            self._discard(conn)
+            return
+        try:
+            # Never hand a connection with an open transaction to the next caller
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            keep = self._size <= self.maxconn
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the block.
+
+        Nested calls on the same thread reuse the connection already held, so
+        a method calling another method never waits on its own pool.
+        """
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Connection-level failure: drop it so the next checkout reconnects
+            self._local.conn = None
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._local.conn = None
+            self._checkin(conn)
+            raise
+        else:
+            self._local.conn = None
+            self._checkin(conn)
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._metrics['checkouts']
+            return {
+                'backend': 'postgresql',
+                'max_size': self.maxconn,
+                'size': self._size,
+                'idle': len(self._idle),
+                'active': self._size - len(self._idle),
+                'checkouts': checkouts,
+                'timeouts': self._metrics['timeouts'],
+                'reconnects': self._metrics['reconnects'],
+                'wait_time_avg_ms': round(self._metrics['wait_time_total'] / checkouts * 1000, 3) if checkouts else 0.0,
+                'wait_time_max_ms': round(self._metrics['wait_time_max'] * 1000, 3),
+            }
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+class SQLiteCursor(sqlite3.Cursor):
+    """Accept the psycopg2-style %s placeholders used throughout Database"""
+
+    def execute(self, query, params=()):
+        return super().execute(query.replace('%s', '?'), params)
+
+    def executemany(self, query, seq_of_params):
+        return super().executemany(query.replace('%s', '?'), seq_of_params)
+
+class SQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+class SQLitePool:
+    """One SQLite connection per thread, in WAL mode, for the development path.
+
+    WAL lets readers proceed while another thread writes, and giving every
+    thread its own connection removes the shared-connection rollback hazard.
+    Under gevent every request is its own "thread", so with ``shared`` set
+    connections come from a fixed set of that size instead, checked out per
+    outermost ``connection()`` block. Exposes the same
+    ``connection()``/``stats()`` interface as ConnectionPool.
+    """
+
+    def __init__(self, path, timeout=30, shared=0):
+        self.path = path
+        self.timeout = timeout
+        self.shared = shared
+        self._free = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._active = 0
+        self._checkouts = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, factory=SQLiteConnection,
+                               check_same_thread=not self.shared)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _thread_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self._lock:
+                self._connections += 1
+        return conn
+
+    def _take(self):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            # Reserve the slot before opening, so concurrent callers can't overshoot
+            grow = self._connections < self.shared
+            if grow:
+                self._connections += 1
+        if grow:
+            try:
+                return self._open()
+            except Exception:
+                with self._lock:
+                    self._connections -= 1
+                raise
+        try:
+            return self._free.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError("Database is busy. Please try again.")
+
+    @contextmanager
+    def connection(self):
+        depth = getattr(self._local, 'depth', 0)
+        if depth:
+            conn = self._local.held
+        else:
+            conn = self._take() if self.shared else self._thread_connection()
+            self._local.held = conn
+        self._local.depth = depth + 1
+        if depth == 0:
+            with self._lock:
+                self._active += 1
+                self._checkouts += 1
+        try:
+            yield conn
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                self._local.held = None
+                if conn.in_transaction:
+                    conn.rollback()
+                if self.shared:
+                    self._free.put(conn)
+                with self._lock:
+                    self._active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'sqlite',
+                'size': self._connections,
+                'idle': self._connections - self._active,
+                'active': self._active,
+                'checkouts': self._checkouts,
+                'wait_time_avg_ms': 0.0,
+                'wait_time_max_ms': 0.0,
+            }
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        while True:
+            try:
+                self._free.get_nowait().close()
+            except queue.Empty:
+                break
 
 class Database:
-    def __init__(self):
-        self.conn = self.get_db_connection()
-        self.create_tables()
-        self.create_indexes()
+    # History pages list rows without the (large) answer text; see get_question
+    QUESTION_LIST_COLUMNS = 'id, question_type, content, image_path, timestamp, cost, response_preview'
+    PAYMENT_LIST_COLUMNS = 'id, amount, mpesa_receipt, status, transaction_date'
+    RESPONSE_PREVIEW_LENGTH = 160
+    # Kept per day and plan in daily_rollups and all-time per plan in rollup_totals;
+    # daily_rollups also has active_subscribers, which has no all-time total
+    ROLLUP_COUNTERS = ('payments_started', 'payments_completed', 'payments_failed', 'revenue',
+                       'text_questions', 'image_questions', 'subscriptions_started')
+
+    def __init__(self, archive=None):
+        # Answers are stored compressed in question_responses, and moved to
+        # files in ``archive`` (a BlobStore) once old; see archive-responses
+        self.archive = archive
+        self.pool = self.create_pool()
+        self.schema_version = migrations.migrate(self.pool, self.dialect)
+        logging.info(f"Database schema at version {self.schema_version}")
 
-    def get_db_connection(self):
-        """Connect to PostgreSQL in production, SQLite in development"""
+    def create_pool(self):
+        """Pool PostgreSQL connections in production, per-thread SQLite in development"""
         db_url = os.getenv('DATABASE_URL')
         
         if db_url:
             # Production - PostgreSQL
             parsed = urlparse(db_url)
-            conn = psycopg2.connect(
-                dbname=parsed.path[1:],
-                user=parsed.username,
-                password=parsed.password,
-                host=parsed.hostname,
-                port=parsed.port
+
+            def connect():
+                return psycopg2.connect(
+                    dbname=parsed.path[1:],
+                    user=parsed.username,
+                    password=parsed.password,
+                    host=parsed.hostname,
+                    port=parsed.port,
+                    connect_timeout=10
+                )
+
+            self.dialect = 'postgresql'
+            pool = ConnectionPool(
+                connect,
+                minconn=int(os.getenv('DB_POOL_MIN', 1)),
+                maxconn=int(os.getenv('DB_POOL_MAX', 10)),
+                timeout=float(os.getenv('DB_POOL_TIMEOUT', 30))
             )
             logging.info("Connected to PostgreSQL database")
         else:
             # Development - SQLite
-            conn = sqlite3.connect('homework_helper.db', check_same_thread=False)
-            conn.row_factory = sqlite3.Row
+            self.dialect = 'sqlite'
+            # Under gevent, a fixed set of connections shared by the request greenlets
+            pool = SQLitePool(os.getenv('SQLITE_PATH', 'homework_helper.db'),
+                              shared=int(os.getenv('DB_POOL_MAX', 10)) if COOPERATIVE else 0)
             logging.info("Connected to SQLite database")
-        return conn
+        return pool
 
-    def create_tables(self):
-        cursor = self.conn.cursor()
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def add_user(self, username, password_hash, email=None, phone=None):
+        """Insert a user; hash the password with PasswordHasher first"""
+        with self.pool.connection() as conn:
+            cursor = None
         
-        # Users table
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                INSERT INTO users (username, password_hash, email, phone)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+                ''', (username, password_hash, email, phone))
+                user_id = cursor.fetchone()[0]
+                conn.commit()
+                return user_id
+            except (psycopg2.IntegrityError, sqlite3.IntegrityError) as e:
+                conn.rollback()
+                raise ValueError("Username, email or phone already exists")
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Error adding user: {e}")
+                raise RuntimeError("Failed to create user")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_credentials(self, username):
+        """Return (id, password_hash) for an active user, or None; see authenticate()"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT id, password_hash FROM users 
+                WHERE username = %s AND is_active = TRUE
+                ''', (username,))
+                return cursor.fetchone()
+            except Exception as e:
+                logging.error(f"Authentication error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def update_password_hash(self, user_id, password_hash):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE users SET password_hash = %s WHERE id = %s
+                ''', (password_hash, user_id))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Update password hash error: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_user(self, user_id):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT id, username, email, phone FROM users 
+                WHERE id = %s AND is_active = TRUE
+                ''', (user_id,))
+                return cursor.fetchone()
+            except Exception as e:
+                logging.error(f"Get user error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def _bump_data_version(self, cursor, user_id):
+        """Mark the user's dashboard data as changed, inside the caller's transaction"""
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            email TEXT UNIQUE,
-            phone TEXT UNIQUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT TRUE
-        )
-        ''')
+        UPDATE users SET data_version = data_version + 1 WHERE id = %s
+        ''', (user_id,))
+
+    def get_data_version(self, user_id):
+        """Cheap primary-key read of the user's data version; None if no such active user"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT data_version FROM users 
+                WHERE id = %s AND is_active = TRUE
+                ''', (user_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+            except Exception as e:
+                logging.error(f"Get data version error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def _json_rows(self, columns, order):
+        """SQL aggregating a subquery's rows into one JSON array of arrays"""
+        if self.dialect == 'postgresql':
+            return f"COALESCE(json_agg(json_build_array({columns}) ORDER BY {order}), '[]')"
+        return f"json_group_array(json_array({columns}))"
+
+    def get_dashboard(self, user_id, limit=10):
+        """Load everything /dashboard shows in a single query.
+
+        Returns a dict with the user row, active subscription, the newest
+        ``limit`` questions and payments (list projections), and the
+        data_version it was read at, or None if the user doesn't exist.
+        """
+        question_columns = self.QUESTION_LIST_COLUMNS
+        payment_columns = self.PAYMENT_LIST_COLUMNS
+        active_subscription = '''
+            FROM subscriptions 
+            WHERE user_id = u.id AND is_active = TRUE AND end_date > CURRENT_TIMESTAMP
+            ORDER BY end_date DESC LIMIT 1
+        '''
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                SELECT u.id, u.username, u.email, u.phone, u.data_version,
+                    (SELECT plan_type {active_subscription}),
+                    (SELECT end_date {active_subscription}),
+                    (SELECT {self._json_rows(question_columns, 'timestamp DESC, id DESC')}
+                     FROM (SELECT {question_columns} FROM questions 
+                           WHERE user_id = u.id ORDER BY timestamp DESC, id DESC LIMIT %s) recent_questions),
+                    (SELECT {self._json_rows(payment_columns, 'transaction_date DESC, id DESC')}
+                     FROM (SELECT {payment_columns} FROM payments 
+                           WHERE user_id = u.id ORDER BY transaction_date DESC, id DESC LIMIT %s) recent_payments)
+                FROM users u
+                WHERE u.id = %s AND u.is_active = TRUE
+                ''', (limit, limit, user_id))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                
+                # psycopg2 decodes json columns itself; SQLite returns text
+                questions, payments = (json.loads(v) if isinstance(v, str) else v for v in row[7:9])
+                return {
+                    'user': tuple(row[0:4]),
+                    'version': row[4],
+                    'subscription': (row[5], parse_timestamp(row[6])) if row[5] else None,
+                    'questions': questions,
+                    'payments': payments,
+                }
+            except Exception as e:
+                logging.error(f"Get dashboard error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_user_subscription(self, user_id):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT plan_type, end_date FROM subscriptions 
+                WHERE user_id = %s AND is_active = TRUE AND end_date > CURRENT_TIMESTAMP
+                ORDER BY end_date DESC LIMIT 1
+                ''', (user_id,))
+                return cursor.fetchone()
+            except Exception as e:
+                logging.error(f"Get subscription error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def create_subscription(self, user_id, plan_type, payment_id=None):
+        start_date = datetime.now()
+        end_date = start_date + timedelta(days=30) if plan_type == "monthly" else None
+        with self.pool.connection() as conn:
+            cursor = None
         
-        # Subscriptions table
+            try:
+                cursor = conn.cursor()
+                if payment_id is not None:
+                    # Claim the payment, so a retried callback can't subscribe twice
+                    cursor.execute('''
+                    UPDATE payments SET fulfilled_at = %s 
+                    WHERE id = %s AND fulfilled_at IS NULL
+                    ''', (start_date, payment_id))
+                    if cursor.rowcount == 0:
+                        conn.rollback()
+                        return None
+                cursor.execute('''
+                SELECT plan_type, end_date FROM subscriptions 
+                WHERE user_id = %s AND is_active = TRUE
+                ''', (user_id,))
+                # Replaced subscriptions stop counting from today
+                for old_plan, old_end in cursor.fetchall():
+                    if old_end:
+                        self._roll_up_subscribers(cursor, old_plan, start_date, parse_timestamp(old_end), -1)
+                
+                # Deactivate any existing subscriptions
+                cursor.execute('''
+                UPDATE subscriptions 
+                SET is_active = FALSE 
+                WHERE user_id = %s AND is_active = TRUE
+                ''', (user_id,))
+            
+                # Create new subscription
+                cursor.execute('''
+                INSERT INTO subscriptions (user_id, plan_type, start_date, end_date, payment_id)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+                ''', (user_id, plan_type, start_date, end_date, payment_id))
+            
+                sub_id = cursor.fetchone()[0]
+                self._bump_data_version(cursor, user_id)
+                cursor.execute('''
+                INSERT INTO entitlement_changes (user_id, changed_at) VALUES (%s, %s)
+                ''', (user_id, start_date))
+                self._roll_up(cursor, start_date, plan_type, subscriptions_started=1)
+                if end_date:
+                    self._roll_up_subscribers(cursor, plan_type, start_date, end_date, 1)
+                conn.commit()
+                return sub_id
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Create subscription error: {e}")
+                raise RuntimeError("Failed to create subscription")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def create_payment(self, user_id, amount, phone_number, purpose='question', plan_type=None):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                now = datetime.now()
+                cursor.execute('''
+                INSERT INTO payments (user_id, amount, phone_number, transaction_date, purpose, plan_type)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id
+                ''', (user_id, amount, phone_number, now, purpose, plan_type))
+            
+                payment_id = cursor.fetchone()[0]
+                self._bump_data_version(cursor, user_id)
+                self._roll_up(cursor, now, payment_plan(purpose, plan_type), payments_started=1)
+                conn.commit()
+                return payment_id
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Create payment error: {e}")
+                raise RuntimeError("Failed to create payment record")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def update_payment(self, payment_id, mpesa_receipt, status='completed'):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                now = datetime.now()
+                cursor.execute('''
+                SELECT status, amount, purpose, plan_type FROM payments WHERE id = %s
+                ''', (payment_id,))
+                previous = cursor.fetchone()
+                cursor.execute('''
+                UPDATE payments 
+                SET mpesa_receipt = %s, status = %s, transaction_date = %s
+                WHERE id = %s
+                ''', (mpesa_receipt, status, now, payment_id))
+            
+                cursor.execute('''
+                UPDATE users SET data_version = data_version + 1 
+                WHERE id = (SELECT user_id FROM payments WHERE id = %s)
+                ''', (payment_id,))
+                if previous and previous[0] == 'pending':
+                    self._roll_up_payment(cursor, now, status, *previous[1:])
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Update payment error: {e}")
+                raise RuntimeError("Failed to update payment")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def attach_checkout(self, payment_id, checkout_request_id, merchant_request_id):
+        """Remember the STK push ids so the callback can find this payment"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE payments 
+                SET checkout_request_id = %s, merchant_request_id = %s
+                WHERE id = %s
+                ''', (checkout_request_id, merchant_request_id, payment_id))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Attach checkout error: {e}")
+                raise RuntimeError("Failed to update payment")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def resolve_payment(self, checkout_request_id, status, mpesa_receipt=None, result_desc=None):
+        """Move a pending payment to its final status in one indexed update.
+
+        Returns (payment_id, user_id, purpose, plan_type), or None when no
+        pending payment matches - e.g. M-Pesa retrying a callback we already
+        processed - so callers can skip the follow-up work.
+        """
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                now = datetime.now()
+                cursor.execute('''
+                UPDATE payments 
+                SET status = %s, mpesa_receipt = %s, result_desc = %s, transaction_date = %s
+                WHERE checkout_request_id = %s AND status = 'pending'
+                RETURNING id, user_id, purpose, plan_type, amount
+                ''', (status, mpesa_receipt, result_desc, now, checkout_request_id))
+            
+                row = cursor.fetchone()
+                if row:
+                    self._bump_data_version(cursor, row[1])
+                    self._roll_up_payment(cursor, now, status, row[4], row[2], row[3])
+                conn.commit()
+                return tuple(row[:4]) if row else None
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Resolve payment error: {e}")
+                raise RuntimeError("Failed to update payment")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def mark_payment_fulfilled(self, payment_id):
+        """Claim a completed payment's follow-up; False if another delivery already has it"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE payments SET fulfilled_at = %s WHERE id = %s AND fulfilled_at IS NULL
+                ''', (datetime.now(), payment_id))
+                claimed = cursor.rowcount == 1
+            
+                conn.commit()
+                return claimed
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Mark payment fulfilled error: {e}")
+                raise RuntimeError("Failed to update payment")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def unmark_payment_fulfilled(self, payment_id):
+        """Give back a claim whose follow-up failed, so a retry or the sweeper runs it again"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE payments SET fulfilled_at = NULL WHERE id = %s
+                ''', (payment_id,))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Unmark payment fulfilled error: {e}")
+                raise RuntimeError("Failed to update payment")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_unfulfilled_payment(self, checkout_request_id):
+        """(payment_id, user_id, purpose, plan_type) of a completed payment still awaiting its follow-up, or None"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT id, user_id, purpose, plan_type FROM payments
+                WHERE checkout_request_id = %s AND status = 'completed' AND fulfilled_at IS NULL
+                ''', (checkout_request_id,))
+                row = cursor.fetchone()
+                return tuple(row) if row else None
+            except Exception as e:
+                logging.error(f"Get unfulfilled payment error: {e}")
+                raise RuntimeError("Failed to read payment")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_unfulfilled_payments(self, before, limit=100):
+        """Completed payments resolved before a time whose follow-up never finished"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT id, user_id, purpose, plan_type FROM payments
+                WHERE status = 'completed' AND fulfilled_at IS NULL AND transaction_date < %s
+                ORDER BY transaction_date
+                LIMIT %s
+                ''', (before, limit))
+                return [tuple(row) for row in cursor.fetchall()]
+            except Exception as e:
+                logging.error(f"Get unfulfilled payments error: {e}")
+                return []
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_pending_payment_amount(self, checkout_request_id):
+        """Amount a still-pending STK push asked for, or None"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT amount FROM payments
+                WHERE checkout_request_id = %s AND status = 'pending'
+                ''', (checkout_request_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+            except Exception as e:
+                logging.error(f"Get pending payment amount error: {e}")
+                raise RuntimeError("Failed to read payment")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_payment_status(self, payment_id, user_id):
+        """Return (status, purpose, job_id) for one of the user's payments, or None"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT p.status, p.purpose, q.job_id 
+                FROM payments p
+                LEFT JOIN pending_questions q ON q.payment_id = p.id
+                WHERE p.id = %s AND p.user_id = %s
+                ''', (payment_id, user_id))
+                return cursor.fetchone()
+            except Exception as e:
+                logging.error(f"Get payment status error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def create_pending_question(self, payment_id, user_id, question_type, content, image_path):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                INSERT INTO pending_questions (payment_id, user_id, question_type, content, image_path)
+                VALUES (%s, %s, %s, %s, %s)
+                ''', (payment_id, user_id, question_type, content, image_path))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Create pending question error: {e}")
+                raise RuntimeError("Failed to save question")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_pending_question(self, payment_id):
+        """Return (user_id, question_type, content, image_path, job_id) or None"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT user_id, question_type, content, image_path, job_id 
+                FROM pending_questions 
+                WHERE payment_id = %s
+                ''', (payment_id,))
+                return cursor.fetchone()
+            except Exception as e:
+                logging.error(f"Get pending question error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def set_pending_question_job(self, payment_id, job_id):
+        """Link the answer job to the paid question"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE pending_questions SET job_id = %s WHERE payment_id = %s
+                ''', (job_id, payment_id))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Set pending question job error: {e}")
+                raise RuntimeError("Failed to save question")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def record_question(self, user_id, question_type, content, image_path, response, cost, payment_id=None,
+                        prompt_tokens=None, completion_tokens=None):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                # Stamped with the app clock, like payments and subscriptions, not the
+                # column default (UTC on SQLite), so all rollups share one calendar day
+                asked_at = datetime.now()
+                cursor.execute('''
+                INSERT INTO questions (user_id, question_type, content, image_path, response_preview, response_ref,
+                                       cost, payment_id, prompt_tokens, completion_tokens, timestamp)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+                ''', (user_id, question_type, content, image_path, self._preview(response),
+                      'db' if response is not None else None, cost, payment_id, prompt_tokens, completion_tokens,
+                      asked_at))
+            
+                question_id = cursor.fetchone()[0]
+                if response is not None:
+                    self._store_response(cursor, question_id, response)
+                self._bump_data_version(cursor, user_id)
+                self._roll_up(cursor, asked_at, question_plan(payment_id),
+                              **{'image_questions' if question_type == 'image' else 'text_questions': 1})
+                conn.commit()
+                return question_id
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Record question error: {e}")
+                raise RuntimeError("Failed to record question")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def _preview(self, response):
+        if response is None:
+            return None
+        preview = ' '.join(response[:self.RESPONSE_PREVIEW_LENGTH * 2].split())
+        if len(preview) <= self.RESPONSE_PREVIEW_LENGTH:
+            return preview
+        return preview[:self.RESPONSE_PREVIEW_LENGTH - 3].rsplit(' ', 1)[0] + '...'
+
+    def _store_response(self, cursor, question_id, response):
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL REFERENCES users(id),
-            plan_type TEXT NOT NULL,
-            start_date TIMESTAMP NOT NULL,
-            end_date TIMESTAMP,
-            is_active BOOLEAN DEFAULT TRUE,
-            payment_id INTEGER REFERENCES payments(id)
-        )
-        ''')
+        INSERT INTO question_responses (question_id, body) VALUES (%s, %s)
+        ''', (question_id, compress_response(response)))
+
+    def _roll_up(self, cursor, when, plan, **counts):
+        """Add counts to the day's and the all-time rollups, in the caller's transaction"""
+        columns = list(counts)
+        increments = ', '.join(f'{c} = {{table}}.{c} + excluded.{c}' for c in columns)
+        values = [counts[c] for c in columns]
+        cursor.execute(f'''
+        INSERT INTO daily_rollups (day, plan, {', '.join(columns)})
+        VALUES (%s, %s, {', '.join(['%s'] * len(columns))})
+        ON CONFLICT (day, plan) DO UPDATE SET {increments.format(table='daily_rollups')}
+        ''', [when.date(), plan] + values)
+        cursor.execute(f'''
+        INSERT INTO rollup_totals (plan, {', '.join(columns)})
+        VALUES (%s, {', '.join(['%s'] * len(columns))})
+        ON CONFLICT (plan) DO UPDATE SET {increments.format(table='rollup_totals')}
+        ''', [plan] + values)
+
+    def _roll_up_payment(self, cursor, when, status, amount, purpose, plan_type):
+        """Count a payment leaving 'pending'"""
+        plan = payment_plan(purpose, plan_type)
+        if status == 'completed':
+            self._roll_up(cursor, when, plan, payments_completed=1, revenue=amount)
+        elif status == 'failed':
+            self._roll_up(cursor, when, plan, payments_failed=1)
+
+    def _roll_up_subscribers(self, cursor, plan, start, end, delta):
+        """Add delta to active_subscribers for each day from start up to (not including) end's day"""
+        days = (end.date() - start.date()).days
+        if days <= 0:
+            return
+        cursor.executemany('''
+        INSERT INTO daily_rollups (day, plan, active_subscribers) VALUES (%s, %s, %s)
+        ON CONFLICT (day, plan) DO UPDATE 
+        SET active_subscribers = daily_rollups.active_subscribers + excluded.active_subscribers
+        ''', [(start.date() + timedelta(days=n), plan, delta) for n in range(days)])
+
+    def _response(self, inline, ref, body):
+        """Answer text from whichever tier response_ref points at"""
+        if ref is None:
+            return inline
+        if ref == 'db':
+            return decompress_response(body)
+        digest = ref.partition(':')[2]
+        data = self.archive.read(digest, '.z') if self.archive else None
+        if data is None:
+            logging.error(f"Archived answer {digest} is missing")
+            return None
+        return decompress_response(data)
+
+    def get_user_questions(self, user_id, limit=10, before=None):
+        """Newest-first page of a user's questions, without responses.
+
+        ``before`` is the (timestamp, id) of the last row of the previous
+        page; seeking past it costs the same on page 1000 as on page 1.
+        """
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                SELECT {self.QUESTION_LIST_COLUMNS} 
+                FROM questions 
+                WHERE user_id = %s {'AND (timestamp, id) < (%s, %s)' if before else ''}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT %s
+                ''', (user_id, *(before or ()), limit))
+            
+                return cursor.fetchall()
+            except Exception as e:
+                logging.error(f"Get questions error: {e}")
+                return []
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_user_payments(self, user_id, limit=10, before=None):
+        """Newest-first page of a user's payments, keyed like get_user_questions"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                SELECT {self.PAYMENT_LIST_COLUMNS} 
+                FROM payments 
+                WHERE user_id = %s {'AND (transaction_date, id) < (%s, %s)' if before else ''}
+                ORDER BY transaction_date DESC, id DESC
+                LIMIT %s
+                ''', (user_id, *(before or ()), limit))
+            
+                return cursor.fetchall()
+            except Exception as e:
+                logging.error(f"Get payments error: {e}")
+                return []
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_question(self, question_id, user_id):
+        """One of the user's questions including its response, or None"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT q.id, q.question_type, q.content, q.image_path, q.response, q.timestamp, q.cost,
+                       q.response_preview, q.response_ref, r.body
+                FROM questions q
+                LEFT JOIN question_responses r ON r.question_id = q.id
+                WHERE q.id = %s AND q.user_id = %s
+                ''', (question_id, user_id))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                return tuple(row[0:4]) + (self._response(row[4], row[8], row[9]),) + tuple(row[5:8])
+            except Exception as e:
+                logging.error(f"Get question error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def create_job(self, job_id, user_id):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                INSERT INTO answer_jobs (id, user_id, status)
+                VALUES (%s, %s, 'queued')
+                ''', (job_id, user_id))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Create job error: {e}")
+                raise RuntimeError("Failed to queue question")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def update_job(self, job_id, status, question_id=None, error=None):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                UPDATE answer_jobs 
+                SET status = %s, question_id = %s, error = %s, updated_at = %s
+                WHERE id = %s
+                ''', (status, question_id, error, datetime.now(), job_id))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Update job error: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_job(self, job_id):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT j.user_id, j.status, j.error, q.response, q.response_ref, r.body 
+                FROM answer_jobs j
+                LEFT JOIN questions q ON q.id = j.question_id
+                LEFT JOIN question_responses r ON r.question_id = q.id
+                WHERE j.id = %s
+                ''', (job_id,))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                return tuple(row[0:3]) + (self._response(row[3], row[4], row[5]),)
+            except Exception as e:
+                logging.error(f"Get job error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_cached_answer(self, cache_key, not_before):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT response FROM answer_cache 
+                WHERE cache_key = %s AND created_at > %s
+                ''', (cache_key, not_before))
+                row = cursor.fetchone()
+                return row[0] if row else None
+            except Exception as e:
+                logging.error(f"Get cached answer error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def store_cached_answer(self, cache_key, response):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                INSERT INTO answer_cache (cache_key, response, created_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE 
+                SET response = excluded.response, created_at = excluded.created_at
+                ''', (cache_key, response, datetime.now()))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Store cached answer error: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def purge_cached_answers(self, older_than):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                DELETE FROM answer_cache WHERE created_at < %s
+                ''', (older_than,))
+                deleted = cursor.rowcount
+                conn.commit()
+                return deleted
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Purge cached answers error: {e}")
+                return 0
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_oauth_token(self, name):
+        """Return (access_token, expires_at) for a cached OAuth token, or None"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT access_token, expires_at FROM oauth_tokens 
+                WHERE name = %s
+                ''', (name,))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                return row[0], parse_timestamp(row[1])
+            except Exception as e:
+                logging.error(f"Get OAuth token error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def store_oauth_token(self, name, access_token, expires_at):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                INSERT INTO oauth_tokens (name, access_token, expires_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (name) DO UPDATE 
+                SET access_token = excluded.access_token, expires_at = excluded.expires_at
+                ''', (name, access_token, expires_at))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Store OAuth token error: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_session(self, session_key):
+        """Return (data, expires_at) for a stored session, or None"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT data, expires_at FROM sessions 
+                WHERE session_key = %s
+                ''', (session_key,))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                return row[0], parse_timestamp(row[1])
+            except Exception as e:
+                logging.error(f"Get session error: {e}")
+                return None
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def store_session(self, session_key, data, expires_at):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                INSERT INTO sessions (session_key, data, expires_at)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (session_key) DO UPDATE 
+                SET data = excluded.data, expires_at = excluded.expires_at
+                ''', (session_key, data, expires_at))
+            
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Store session error: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def delete_session(self, session_key):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                DELETE FROM sessions WHERE session_key = %s
+                ''', (session_key,))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Delete session error: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def purge_expired_sessions(self, now, batch_size=1000):
+        """Delete up to batch_size expired sessions; call again while it returns batch_size"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                DELETE FROM sessions WHERE session_key IN (
+                    SELECT session_key FROM sessions WHERE expires_at < %s LIMIT %s
+                )
+                ''', (now, batch_size))
+                deleted = cursor.rowcount
+                conn.commit()
+                return deleted
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Purge sessions error: {e}")
+                return 0
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_entitlement_changes(self, after_id, limit=1000):
+        """(id, user_id) of subscription changes logged after after_id, oldest first"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT id, user_id FROM entitlement_changes 
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+                ''', (after_id, limit))
+                return cursor.fetchall()
+            # No except: the caller must not mistake a failed poll for "nothing changed"
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_last_entitlement_change(self):
+        """Id of the newest logged subscription change, 0 if none"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT MAX(id) FROM entitlement_changes')
+                return cursor.fetchone()[0] or 0
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def purge_entitlement_changes(self, before):
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                DELETE FROM entitlement_changes WHERE changed_at < %s
+                ''', (before,))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Purge entitlement changes error: {e}")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_inline_responses(self, limit=500):
+        """(question_id, response) of answers still stored in the questions table"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT id, response FROM questions 
+                WHERE response_ref IS NULL AND response IS NOT NULL
+                ORDER BY id
+                LIMIT %s
+                ''', (limit,))
+                return cursor.fetchall()
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def compress_responses(self, rows):
+        """Move (question_id, response) pairs out of questions into question_responses"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                for question_id, response in rows:
+                    self._store_response(cursor, question_id, response)
+                    cursor.execute('''
+                    UPDATE questions 
+                    SET response = NULL, response_preview = %s, response_ref = 'db'
+                    WHERE id = %s
+                    ''', (self._preview(response), question_id))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Compress responses error: {e}")
+                raise
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_archivable_responses(self, before, limit=500):
+        """(question_id, compressed body) of database-stored answers older than before"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT q.id, r.body 
+                FROM questions q
+                JOIN question_responses r ON r.question_id = q.id
+                WHERE q.timestamp < %s AND q.response_ref = 'db'
+                ORDER BY q.timestamp
+                LIMIT %s
+                ''', (before, limit))
+                return cursor.fetchall()
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def mark_responses_archived(self, rows):
+        """Point (question_id, digest) pairs at their archive file and drop the database copy"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                for question_id, digest in rows:
+                    cursor.execute('''
+                    UPDATE questions SET response_ref = %s WHERE id = %s
+                    ''', (f'archive:{digest}', question_id))
+                    cursor.execute('''
+                    DELETE FROM question_responses WHERE question_id = %s
+                    ''', (question_id,))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Mark responses archived error: {e}")
+                raise
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_token_spend(self, since):
+        """AI token totals per user and plan since a timestamp, biggest spenders first.
+
+        Rows are (user_id, username, plan, questions, prompt_tokens,
+        completion_tokens); questions asked with no payment of their own were
+        covered by a monthly subscription. Questions from before token
+        accounting count towards ``questions`` only.
+        """
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT s.user_id, u.username, s.plan, s.questions, s.prompt_tokens, s.completion_tokens
+                FROM (
+                    SELECT user_id,
+                           CASE WHEN payment_id IS NULL THEN 'monthly' ELSE 'pay_per_use' END AS plan,
+                           COUNT(*) AS questions,
+                           COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+                           COALESCE(SUM(completion_tokens), 0) AS completion_tokens
+                    FROM questions
+                    WHERE timestamp >= %s
+                    GROUP BY user_id, CASE WHEN payment_id IS NULL THEN 'monthly' ELSE 'pay_per_use' END
+                ) s
+                JOIN users u ON u.id = s.user_id
+                ORDER BY s.prompt_tokens + s.completion_tokens DESC, s.user_id
+                ''', (since,))
+                return cursor.fetchall()
+            except Exception as e:
+                logging.error(f"Get token spend error: {e}")
+                return []
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_rollups(self, since):
+        """Daily rollup rows from a day on, oldest first: (day, plan, *ROLLUP_COUNTERS, active_subscribers)"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                SELECT day, plan, {', '.join(self.ROLLUP_COUNTERS)}, active_subscribers
+                FROM daily_rollups
+                WHERE day >= %s AND day <= %s
+                ORDER BY day, plan
+                ''', (since, datetime.now().date()))
+                return cursor.fetchall()
+            except Exception as e:
+                logging.error(f"Get rollups error: {e}")
+                return []
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_rollup_totals(self, plans):
+        """All-time rollup rows for the given plans: (plan, *ROLLUP_COUNTERS)"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                SELECT plan, {', '.join(self.ROLLUP_COUNTERS)}
+                FROM rollup_totals
+                WHERE plan IN ({', '.join(['%s'] * len(plans))})
+                ORDER BY plan
+                ''', tuple(plans))
+                return cursor.fetchall()
+            except Exception as e:
+                logging.error(f"Get rollup totals error: {e}")
+                return []
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def _read_batches(self, cursor, query, batch_size):
+        """Yield the rows of ``query`` (which selects id first) in keyset batches by id"""
+        last_id = 0
+        while True:
+            cursor.execute(query, (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
+
+    def rebuild_rollups(self, batch_size=1000):
+        """Recompute every rollup from payments, questions and subscriptions.
+
+        Runs as one transaction holding the rollup tables, so writes that would
+        update them wait until it commits and are counted exactly once. Source
+        rows are read in id order in batches. A payment's start and outcome
+        are both dated by its transaction_date, which the outcome overwrites.
+        Returns the number of (day, plan) rows written.
+        """
+        daily = {}
+        totals = {}
         
-        # Payments table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL REFERENCES users(id),
-            amount REAL NOT NULL,
-            mpesa_receipt TEXT,
-            phone_number TEXT NOT NULL,
-            transaction_date TIMESTAMP,
-            status TEXT DEFAULT 'pending',
-            CHECK (status IN ('pending', 'completed', 'failed'))
-        )
-        ''')
+        def add(when, plan, **counts):
+            for key, bucket in (((when.date(), plan), daily), (plan, totals)):
+                row = bucket.setdefault(key, Counter())
+                row.update(counts)
         
-        # Questions table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS questions (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL REFERENCES users(id),
-            question_type TEXT NOT NULL,
-            content TEXT,
-            image_path TEXT,
-            response TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            cost REAL NOT NULL,
-            payment_id INTEGER REFERENCES payments(id)
-        )
-        ''')
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                if self.dialect == 'postgresql':
+                    cursor.execute('LOCK TABLE daily_rollups, rollup_totals IN EXCLUSIVE MODE')
+                else:
+                    cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute('DELETE FROM daily_rollups')
+                cursor.execute('DELETE FROM rollup_totals')
+                
+                for _, when, status, amount, purpose, plan_type in self._read_batches(cursor, '''
+                SELECT id, transaction_date, status, amount, purpose, plan_type FROM payments
+                WHERE id > %s ORDER BY id LIMIT %s
+                ''', batch_size):
+                    if when is None:
+                        continue
+                    when = parse_timestamp(when)
+                    plan = payment_plan(purpose, plan_type)
+                    add(when, plan, payments_started=1)
+                    if status == 'completed':
+                        add(when, plan, payments_completed=1, revenue=amount)
+                    elif status == 'failed':
+                        add(when, plan, payments_failed=1)
+                
+                for _, when, question_type, payment_id in self._read_batches(cursor, '''
+                SELECT id, timestamp, question_type, payment_id FROM questions
+                WHERE id > %s ORDER BY id LIMIT %s
+                ''', batch_size):
+                    if when is not None:
+                        add(parse_timestamp(when), question_plan(payment_id),
+                            **{'image_questions' if question_type == 'image' else 'text_questions': 1})
+                
+                # A new subscription ends the user's previous one on its start day
+                current = {}
+                subscribed = []
+                for _, user_id, plan_type, start, end in self._read_batches(cursor, '''
+                SELECT id, user_id, plan_type, start_date, end_date FROM subscriptions
+                WHERE id > %s ORDER BY id LIMIT %s
+                ''', batch_size):
+                    start, end = parse_timestamp(start), parse_timestamp(end) if end else None
+                    add(start, plan_type, subscriptions_started=1)
+                    previous = current.get(user_id)
+                    if previous:
+                        subscribed.append((previous[0], previous[1], min(previous[2], start)))
+                    current[user_id] = (plan_type, start, end) if end else None
+                subscribed.extend(filter(None, current.values()))
+                active = Counter()
+                for plan, start, end in subscribed:
+                    for n in range((end.date() - start.date()).days):
+                        active[(start.date() + timedelta(days=n), plan)] += 1
+                
+                for day, plan in set(daily) | set(active):
+                    counts = daily.get((day, plan), Counter())
+                    cursor.execute(f'''
+                    INSERT INTO daily_rollups (day, plan, {', '.join(self.ROLLUP_COUNTERS)}, active_subscribers)
+                    VALUES (%s, %s, {', '.join(['%s'] * (len(self.ROLLUP_COUNTERS) + 1))})
+                    ''', [day, plan] + [counts[c] for c in self.ROLLUP_COUNTERS] + [active[(day, plan)]])
+                for plan, counts in totals.items():
+                    cursor.execute(f'''
+                    INSERT INTO rollup_totals (plan, {', '.join(self.ROLLUP_COUNTERS)})
+                    VALUES (%s, {', '.join(['%s'] * len(self.ROLLUP_COUNTERS))})
+                    ''', [plan] + [counts[c] for c in self.ROLLUP_COUNTERS])
+                conn.commit()
+                return len(set(daily) | set(active))
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Rebuild rollups error: {e}")
+                raise RuntimeError("Failed to rebuild rollups")
+            finally:
+                if cursor:
+                    cursor.close()
+
+    def get_referenced_images(self):
+        """Image digests still referenced by a question or a question awaiting payment"""
+        with self.pool.connection() as conn:
+            cursor = None
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT image_path FROM questions 
+                WHERE image_path IS NOT NULL
+                UNION
+                SELECT image_path FROM pending_questions
+                WHERE image_path IS NOT NULL
+                ''')
+                return {row[0] for row in cursor.fetchall()}
+            # No except: a failed query must never look like "nothing is referenced"
+            finally:
+                if cursor:
+                    cursor.close()
+
+def split_top_level(text, separator=','):
+    """Split on separators outside parentheses"""
+    parts, depth, start = [], 0, 0
+    for i, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts]
+
+def result_columns(statement):
+    """Names of the columns a statement returns, from RETURNING or its outermost SELECT list"""
+    upper = statement.upper()
+    depth = 0
+    for i, char in enumerate(statement):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and upper.startswith('RETURNING ', i):
+            return [column_name(e) for e in split_top_level(statement[i + len('RETURNING '):])]
+    if not upper.startswith('SELECT '):
+        return []
+    depth = 0
+    for i, char in enumerate(statement):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and upper.startswith(' FROM ', i):
+            return [column_name(e) for e in split_top_level(statement[len('SELECT '):i])]
+    return [column_name(e) for e in split_top_level(statement[len('SELECT '):])]
+
+def column_name(expression):
+    """'u.id' -> 'id', 'COUNT(*) AS questions' -> 'questions', '(SELECT end_date ...)' -> 'end_date'"""
+    alias = re.search(r'\sAS\s+(\w+)$', expression, re.I)
+    if alias:
+        return alias.group(1).lower()
+    if 'json' in expression.lower():
+        return 'json'
+    if expression.startswith('(SELECT '):
+        expression = expression[len('(SELECT '):].split()[0]
+    names = re.findall(r'\w+', expression)
+    return names[-1].lower() if names else ''
+
+def placeholder_value(name):
+    """A value shaped like what a column of this name holds, for planned-but-not-run reads"""
+    if name == 'json':
+        return '[]'
+    if name == 'data':
+        return '{}'
+    if name == 'body':
+        return compress_response('plan check')
+    if name in ('status',):
+        return 'pending'
+    if name in ('plan', 'plan_type'):
+        return 'monthly'
+    if name == 'question_type':
+        return 'text'
+    if name == 'response_ref':
+        return 'db'
+    if name in ('timestamp', 'day') or name.endswith(('_at', '_date')):
+        return datetime.now()
+    if (name == 'id' or name.endswith(('_id', 'tokens', 'version')) or
+            name in ('amount', 'cost', 'revenue', 'questions', 'active_subscribers', '1') or
+            name.startswith(('payments_', 'subscriptions_')) or name.endswith('_questions')):
+        return 1
+    return 'plan-check'
+
+class QueryPlanCheck:
+    """Stands in for the pool and plans Database statements instead of running them.
+
+    Every statement a method issues is sent through EXPLAIN and nothing is
+    ever committed, so the check is safe to run against production. Reads
+    return one placeholder row shaped from the statement's columns, so each
+    method runs on to its later statements; a method that raises or logs an
+    error before finishing is reported as incomplete.
+    """
+
+    def __init__(self, pool, dialect):
+        self.pool = pool
+        self.dialect = dialect
+        self.method = None
+        self.plans = []  # (method, statement, tables read by sequential scan)
+        self.errors = []  # (method, statement, error)
+        self.incomplete = []  # (method, what stopped it)
+
+    @contextmanager
+    def connection(self):
+        with self.pool.connection() as conn:
+            try:
+                if self.dialect == 'postgresql':
+                    # Only fall back to a sequential scan when no index can serve the query
+                    cursor = conn.cursor()
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                    cursor.close()
+                yield ExplainConnection(conn, self)
+            finally:
+                conn.rollback()
+
+    def sequential_scans(self, cursor, statement, params):
+        if self.dialect == 'postgresql':
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, params)
+            nodes = [cursor.fetchone()[0][0]['Plan']]
+            scans = []
+            while nodes:
+                node = nodes.pop()
+                if node['Node Type'] == 'Seq Scan':
+                    scans.append(node['Relation Name'])
+                nodes.extend(node.get('Plans', []))
+            return scans
         
-        self.conn.commit()
-        logging.info("Database tables created/verified")
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, params)
+        details = [row[3].split() for row in cursor.fetchall()]
+        # Subqueries in FROM are scanned too, but they are not tables
+        derived = {d[1] for d in details if d[0] in ('CO-ROUTINE', 'MATERIALIZE')}
+        return [d[1] for d in details if d[0] == 'SCAN' and len(d) == 2 and d[1] not in derived]
+
+    def record(self, cursor, statement, params):
+        statement = ' '.join(statement.split())
+        try:
+            scans = self.sequential_scans(cursor, statement, params)
+        except Exception as e:
+            self.errors.append((self.method, statement, e))
+            raise
+        self.plans.append((self.method, statement, scans))
 
-    def create_indexes(self):
-        cursor = self.conn.cursor()
+    def run(self, database, calls):
+        """Call each Database method through the check; return methods left unchecked"""
+        planner = copy.copy(database)
+        planner.pool = self
+        # Methods catch and log their own failures; hold those records back and count them against the method
+        failures = []
+        def hold(record):
+            if record.levelno >= logging.ERROR:
+                failures.append(record.getMessage())
+            return False
+        root = logging.getLogger()
+        root.addFilter(hold)
         try:
-            # Index for faster subscription checks
-            cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active 
-            ON subscriptions (user_id, end_date) WHERE is_active = TRUE
-            ''')
+            for name, args in calls:
+                self.method = name
+                del failures[:]
+                try:
+                    getattr(planner, name)(*args)
+                except Exception as e:
+                    failures.append(f"{type(e).__name__}: {e}")
+                if failures:
+                    self.incomplete.append((name, failures[0]))
+        finally:
+            root.removeFilter(hold)
+        
+        public = {name for name in vars(Database) if not name.startswith('_') and callable(getattr(Database, name))}
+        # rebuild_rollups locks and rewrites the rollup tables whole, as a one-off maintenance job
+        return sorted(public - {name for name, _ in calls} - {'create_pool', 'pool_stats', 'rebuild_rollups'})
+
+class ExplainConnection:
+    def __init__(self, conn, check):
+        self._conn = conn
+        self._check = check
+
+    def cursor(self):
+        return ExplainCursor(self._conn.cursor(), self._check)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class ExplainCursor:
+    """Plans each statement and returns a placeholder row instead of running it, so writes never happen"""
+
+    rowcount = 1
+
+    def __init__(self, cursor, check):
+        self._cursor = cursor
+        self._check = check
+        self._row = None
+
+    def execute(self, statement, params=()):
+        self._check.record(self._cursor, statement, params)
+        self._row = tuple(placeholder_value(name) for name in result_columns(' '.join(statement.split())))
+
+    def executemany(self, statement, seq_of_params):
+        for params in seq_of_params:
+            self.execute(statement, params)
+            break
+
+    def fetchone(self):
+        row, self._row = self._row, None
+        return row or None
+
+    def fetchall(self):
+        row = self.fetchone()
+        return [row] if row else []
+
+    def close(self):
+        self._cursor.close()
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without touching the network while an upstream's circuit is open"""
+
+class CircuitBreaker:
+    """Fail fast after repeated upstream failures, then let one probe through"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            # Half-open: a single request decides whether the upstream is back
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+class LatencyHistogram:
+    """Cumulative latency buckets in seconds, Prometheus-style"""
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets=None):
+        if buckets:
+            self.BUCKETS = tuple(buckets)
+        self._counts = [0] * (len(self.BUCKETS) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self._sum += seconds
+
+    def snapshot(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'buckets': buckets, 'count': cumulative, 'sum': round(total, 6)}
+
+class SpanMetrics:
+    """Latency histograms per (kind, name) span, e.g. ('db', 'get_dashboard').
+
+    Spans also collect on the current request (see span()) so its
+    Server-Timing header and the slow-request profiler can show where the
+    time went. Metrics are per gunicorn worker.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind, name, seconds):
+        histogram = self._histograms.get((kind, name))
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault((kind, name), LatencyHistogram(self.BUCKETS))
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {key: histogram.snapshot() for key, histogram in sorted(histograms.items())}
+
+@contextmanager
+def span(kind, name):
+    """Time a block into span_metrics and, inside a request, onto g.spans"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        span_metrics.observe(kind, name, seconds)
+        if has_request_context() and 'spans' in g:
+            g.spans.append((kind, name, seconds))
+
+def traced(kind, name=None):
+    """Decorator recording every call as a span"""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument(cls, kind):
+    """Trace every public method of cls, e.g. each Database query"""
+    for attr, value in list(vars(cls).items()):
+        if not attr.startswith('_') and inspect.isfunction(value):
+            setattr(cls, attr, traced(kind, attr)(value))
+
+class SamplingProfiler:
+    """Opt-in wall-clock sampler that keeps stacks only for slow requests.
+
+    A daemon thread samples the stacks of threads serving profiled requests
+    every ``interval`` seconds. Requests slower than ``threshold`` get their
+    samples written in folded-stack format (one ``frame;frame;frame count``
+    line per stack), which flamegraph.pl and speedscope turn into a flamegraph.
+    """
+
+    def __init__(self, threshold, interval=0.005, sample_rate=1.0, output_dir='profiles'):
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self._active = {}  # thread id -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._stats = {'profiled': 0, 'dumped': 0}
+        threading.Thread(target=self._sample_loop, daemon=True, name='sampling-profiler').start()
+
+    def start(self):
+        """Begin sampling the current thread; False if this request wasn't picked"""
+        if random.random() >= self.sample_rate:
+            return False
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            self._stats['profiled'] += 1
+        return True
+
+    def stop(self, label, seconds):
+        """Stop sampling the current thread and dump it if the request was slow"""
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or seconds < self.threshold:
+            return None
+        
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{label}-{int(seconds * 1000)}ms.folded")
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        with self._lock:
+            self._stats['dumped'] += 1
+        return path
+
+    @staticmethod
+    def _fold(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self._fold(frame)] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, active=len(self._active))
+
+class HttpClient:
+    """Shared outbound HTTP layer for the DeepSeek and M-Pesa calls.
+
+    One ``requests.Session`` keeps per-host keep-alive connection pools, so
+    repeat calls skip the TCP+TLS handshake. Requests are retried with
+    jittered exponential backoff on 429/5xx, each host has a circuit breaker,
+    and per-endpoint latency is recorded in histograms.
+    """
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, pool_maxsize=10, retries=2, backoff=0.5, backoff_cap=8,
+                 failure_threshold=5, reset_timeout=30):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _breaker(self, host):
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[host]
+
+    def _observe(self, endpoint, seconds):
+        with self._lock:
+            if endpoint not in self._histograms:
+                self._histograms[endpoint] = LatencyHistogram()
+            histogram = self._histograms[endpoint]
+        histogram.observe(seconds)
+
+    def _sleep_before_retry(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            delay = min(int(retry_after), self.backoff_cap)
+        else:
+            # Full jitter keeps workers that failed together from retrying together
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** attempt))
+        time.sleep(delay)
+
+    def request(self, method, url, endpoint, idempotent=True, retries=None, **kwargs):
+        """Send a request, retrying transient failures.
+
+        Non-idempotent calls (e.g. an STK push, which prompts the customer's
+        phone) are only retried when the upstream cannot have acted on them:
+        a failed connect or an explicit 429.
+        """
+        breaker = self._breaker(urlparse(url).netloc)
+        retries = self.retries if retries is None else retries
+        
+        for attempt in range(retries + 1):
+            last_attempt = attempt == retries
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit open for {urlparse(url).netloc}")
             
-            # Index for payment lookups
-            cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_payments_user_status 
-            ON payments (user_id, status)
-            ''')
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self._observe(endpoint, time.monotonic() - started)
+                breaker.record_failure()
+                retryable = isinstance(e, requests.exceptions.ConnectTimeout) or (
+                    idempotent and isinstance(e, (requests.exceptions.ConnectionError,
+                                                  requests.exceptions.Timeout)))
+                if last_attempt or not retryable:
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
             
-            self.conn.commit()
-        except Exception as e:
-            logging.error(f"Index creation failed: {e}")
-            self.conn.rollback()
+            self._observe(endpoint, time.monotonic() - started)
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            
+            retryable = response.status_code == 429 or (
+                idempotent and response.status_code in self.RETRY_STATUSES)
+            if last_attempt or not retryable:
+                return response
+            self._sleep_before_retry(attempt, response.headers.get('Retry-After'))
+            response.close()
+
+    def get(self, url, endpoint, **kwargs):
+        return self.request('GET', url, endpoint, **kwargs)
+
+    def post(self, url, endpoint, **kwargs):
+        return self.request('POST', url, endpoint, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+            histograms = dict(self._histograms)
+        return {
+            'circuits': {host: breaker.state for host, breaker in breakers.items()},
+            'latency': {endpoint: h.snapshot() for endpoint, h in histograms.items()}
+        }
+
+class TokenManager:
+    """OAuth access token shared by every thread and gunicorn worker.
+
+    Callers that find the token expired share a single refresh (single-flight)
+    instead of each calling the OAuth endpoint. Tokens are cached in the
+    ``oauth_tokens`` table so other workers reuse them, and a background
+    thread renews the token ``refresh_margin`` seconds before it expires, so
+    requests normally never wait on an OAuth round-trip.
+    """
+
+    def __init__(self, name, fetch, database, refresh_margin=300, min_remaining=60):
+        self.name = name
+        self._fetch = fetch  # () -> (access_token, expires_in_seconds)
+        self.db = database
+        self.refresh_margin = refresh_margin
+        self.min_remaining = min_remaining
+        self._token = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stats = {'fetches': 0, 'shared_hits': 0, 'failures': 0}
 
-    def add_user(self, username, password, email=None, phone=None):
-        password_hash = generate_password_hash(password)
-        cursor = None
+    def _valid_for(self, expires_at, seconds):
+        return expires_at is not None and datetime.now() + timedelta(seconds=seconds) < expires_at
+
+    def _refresh(self, min_remaining):
+        """Adopt the shared token if it lasts min_remaining seconds, else fetch one. Caller holds _lock."""
+        shared = self.db.get_oauth_token(self.name)
+        if shared and self._valid_for(shared[1], min_remaining):
+            self._token, self._expires_at = shared
+            self._stats['shared_hits'] += 1
+            return
         
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            INSERT INTO users (username, password_hash, email, phone)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-            ''', (username, password_hash, email, phone))
-            user_id = cursor.fetchone()[0]
-            self.conn.commit()
-            return user_id
-        except (psycopg2.IntegrityError, sqlite3.IntegrityError) as e:
-            self.conn.rollback()
-            raise ValueError("Username, email or phone already exists")
-        except Exception as e:
-            self.conn.rollback()
-            logging.error(f"Error adding user: {e}")
-            raise RuntimeError("Failed to create user")
-        finally:
-            if cursor:
-                cursor.close()
+            token, expires_in = self._fetch()
+        except Exception:
+            self._stats['failures'] += 1
+            raise
+        self._stats['fetches'] += 1
+        self._token = token
+        self._expires_at = datetime.now() + timedelta(seconds=expires_in)
+        self.db.store_oauth_token(self.name, token, self._expires_at)
+
+    def get(self):
+        token, expires_at = self._token, self._expires_at
+        if self._valid_for(expires_at, self.min_remaining):
+            return token
+        
+        with self._lock:
+            # Whoever got the lock first may already have refreshed it
+            if not self._valid_for(self._expires_at, self.min_remaining):
+                self._refresh(self.min_remaining)
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._refresh_loop,
+                                                   name=f'{self.name}-token-refresher', daemon=True)
+                self._refresher.start()
+            return self._token
+
+    def _refresh_loop(self):
+        while True:
+            with self._lock:
+                expires_at = self._expires_at
+            delay = (expires_at - datetime.now()).total_seconds() - self.refresh_margin if expires_at else 0
+            # Jitter so workers don't all wake at once; the first one refreshes the shared token
+            time.sleep(max(delay, 0) + random.uniform(1, 30))
+            try:
+                with self._lock:
+                    if not self._valid_for(self._expires_at, self.refresh_margin):
+                        self._refresh(self.refresh_margin)
+            except Exception as e:
+                logging.warning(f"Background {self.name} token refresh failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats,
+                        expires_in=int((self._expires_at - datetime.now()).total_seconds())
+                        if self._expires_at else None)
 
-    def authenticate_user(self, username, password):
-        cursor = None
+class MpesaGateway:
+    def __init__(self, http, database, callback_token):
+        self.http = http
+        self.api_url = os.getenv('MPESA_API_URL', 'https://sandbox.safaricom.co.ke')
+        self.consumer_key = os.getenv('MPESA_CONSUMER_KEY')
+        self.consumer_secret = os.getenv('MPESA_CONSUMER_SECRET')
+        self.business_shortcode = os.getenv('MPESA_BUSINESS_SHORTCODE')
+        self.passkey = os.getenv('MPESA_PASSKEY')
+        self.callback_url = os.getenv('MPESA_CALLBACK_URL')
+        self.callback_token = callback_token
+        self.tokens = TokenManager('mpesa', self._fetch_access_token, database)
+        
+    @traced('mpesa')
+    def get_access_token(self):
+        return self.tokens.get()
+
+    @traced('mpesa', 'fetch_access_token')
+    def _fetch_access_token(self):
+        auth_url = f'{self.api_url}/oauth/v1/generate?grant_type=client_credentials'
+        auth = (self.consumer_key, self.consumer_secret)
+        
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT id, password_hash FROM users 
-            WHERE username = %s AND is_active = TRUE
-            ''', (username,))
-            result = cursor.fetchone()
-            
-            if not result:
-                return None
-                
-            user_id, stored_hash = result
-            if check_password_hash(stored_hash, password):
-                return user_id
-            return None
-        except Exception as e:
-            logging.error(f"Authentication error: {e}")
+            response = self.http.get(auth_url, endpoint='mpesa.oauth', auth=auth, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+            return data['access_token'], int(data['expires_in'])
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Failed to get M-Pesa access token: {e}")
+            raise RuntimeError("M-Pesa authentication failed")
+
+    @traced('mpesa')
+    def stk_push(self, phone_number, amount, account_reference, description):
+        token = self.get_access_token()
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(
+            f"{self.business_shortcode}{self.passkey}{timestamp}".encode()
+        ).decode()
+        
+        payload = {
+            "BusinessShortCode": self.business_shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PartyB": self.business_shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": f"{self.callback_url}/callback/{self.callback_token}",
+            "AccountReference": account_reference,
+            "TransactionDesc": description
+        }
+        
+        headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        
+        try:
+            response = self.http.post(
+                f'{self.api_url}/mpesa/stkpush/v1/processrequest',
+                endpoint='mpesa.stk_push',
+                idempotent=False,
+                headers=headers,
+                json=payload,
+                timeout=15
+            )
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logging.error(f"STK push failed: {e}")
+            raise RuntimeError("Payment request failed")
+
+class DatabaseSession(SecureCookieSession):
+    """Session dict that remembers which sessions row it came from"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires_at = expires_at
+
+class DatabaseSessionInterface(SessionInterface):
+    """Sessions kept in the sessions table, shared by every worker.
+
+    The cookie holds a random id; rows are keyed by its SHA-256 so a copy
+    of the table can't be replayed. An unchanged session is only written
+    back once half its lifetime has passed, so most requests cost one
+    primary-key read. Expired rows are deleted in batches in the background.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, database, purge_interval=3600, purge_batch_size=1000):
+        self.db = database
+        self.purge_interval = purge_interval
+        self.purge_batch_size = purge_batch_size
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._stats = {'reads': 0, 'writes': 0, 'skipped_writes': 0, 'deletes': 0, 'purged': 0}
+
+    @staticmethod
+    def _key(sid):
+        return hashlib.sha256(sid.encode()).hexdigest()
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            self._count('reads')
+            row = self.db.get_session(self._key(sid))
+            if row and row[1] > datetime.now():
+                return DatabaseSession(self.serializer.loads(row[0]), sid, row[1])
+        return DatabaseSession()
+
+    def save_session(self, app, session, response):
+        self._maybe_purge()
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        
+        if not session:
+            if session.sid:
+                self.db.delete_session(self._key(session.sid))
+                self._count('deletes')
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        
+        now = datetime.now()
+        lifetime = app.permanent_session_lifetime
+        if not session.modified and session.expires_at and session.expires_at - now > lifetime / 2:
+            self._count('skipped_writes')
+            return
+        
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        self.db.store_session(self._key(session.sid), self.serializer.dumps(dict(session)), now + lifetime)
+        self._count('writes')
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+    def purge(self):
+        """Delete every expired session, a batch per transaction"""
+        total = 0
+        while True:
+            deleted = self.db.purge_expired_sessions(datetime.now(), self.purge_batch_size)
+            total += deleted
+            if deleted < self.purge_batch_size:
+                break
+        self._count('purged', total)
+        return total
+
+    def _maybe_purge(self):
+        with self._lock:
+            purge_due = time.monotonic() - self._last_purge > self.purge_interval
+            if purge_due:
+                self._last_purge = time.monotonic()
+        if purge_due:
+            threading.Thread(target=self.purge, daemon=True, name='session-purge').start()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, backend='database')
+
+class DashboardCache:
+    """Per-user dashboard data, reused while the user's data_version is unchanged.
+
+    Every write that changes what the dashboard shows bumps ``users.data_version``
+    in the same transaction, so a cached entry is invalidated by writes from any
+    worker, at the cost of one primary-key read per dashboard view.
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> (version, data)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, user_id, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(user_id)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
             return None
+
+    def set(self, user_id, version, data):
+        with self._lock:
+            self._entries[user_id] = (version, data)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
+
+class FragmentCache:
+    """Rendered template fragments, keyed by name and what they render from.
+
+    Keys carry the data a fragment depends on (e.g. the user's data_version),
+    so a write makes the old key miss and its entry just ages out of the LRU.
+    Templates use it through the ``fragment`` global::
+
+        {% call fragment('questions', user[0], version) %}...{% endcall %}
+    """
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> rendered HTML
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def render(self, key, render):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return html
+            self._stats['misses'] += 1
+        
+        html = render()
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._entries))
+
+class EntitlementCache:
+    """Per-user (plan_type, end_date) of the active subscription, kept in memory.
+
+    Expiry is checked locally against ``end_date``, so an ended subscription
+    stops counting without a query. Entries are dropped when this worker
+    creates a subscription; with ``sync_interval`` set, each worker also
+    polls ``entitlement_changes`` (written in the same transaction as the
+    subscription) and drops entries other workers changed. ``ttl`` bounds
+    staleness if polling is off or failing.
+    """
+    SYNC_BATCH = 1000
+    PURGE_INTERVAL = 3600
+    CHANGE_RETENTION = timedelta(days=1)
+
+    def __init__(self, database, max_entries=5000, ttl=300, sync_interval=2):
+        self.db = database
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self._entries = OrderedDict()  # user_id -> (subscription or None, cached_at)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._syncing = False
+        self._last_sync = time.monotonic()
+        self._last_purge = time.monotonic()
+        self._last_change_id = database.get_last_entitlement_change() if sync_interval else 0
+        self._stats = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidations': 0, 'sync_errors': 0}
+
+    def get(self, user_id):
+        """Return (plan_type, end_date) of the user's active subscription, or None"""
+        self._maybe_sync()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[1] < self.ttl:
+                subscription = entry[0]
+                if subscription and subscription[1] and subscription[1] <= datetime.now():
+                    # Ended since it was cached; only one subscription is ever active
+                    subscription = None
+                    self._entries[user_id] = (None, entry[1])
+                    self._stats['expired'] += 1
+                self._entries.move_to_end(user_id)
+                self._stats['hits'] += 1
+                return subscription
+            self._stats['misses'] += 1
+            generation = self._generation
+
+        row = self.db.get_user_subscription(user_id)
+        subscription = (row[0], parse_timestamp(row[1])) if row else None
+        with self._lock:
+            # Skip caching if an invalidation raced with the read
+            if generation == self._generation:
+                self._entries[user_id] = (subscription, now)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return subscription
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                if self._entries.pop(user_id, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def _maybe_sync(self):
+        if not self.sync_interval:
+            return
+        with self._lock:
+            if self._syncing or time.monotonic() - self._last_sync < self.sync_interval:
+                return
+            self._syncing = True
+        try:
+            self.sync()
         finally:
-            if cursor:
-                cursor.close()
+            with self._lock:
+                self._syncing = False
+                self._last_sync = time.monotonic()
 
-    def get_user(self, user_id):
-        cursor = None
+    def sync(self):
+        """Drop entries for users whose subscription changed on any worker"""
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT id, username, email, phone FROM users 
-            WHERE id = %s AND is_active = TRUE
-            ''', (user_id,))
-            return cursor.fetchone()
+            while True:
+                changes = self.db.get_entitlement_changes(self._last_change_id, self.SYNC_BATCH)
+                if changes:
+                    self.invalidate(*{user_id for _, user_id in changes})
+                    self._last_change_id = changes[-1][0]
+                if len(changes) < self.SYNC_BATCH:
+                    break
+            if time.monotonic() - self._last_purge > self.PURGE_INTERVAL:
+                self._last_purge = time.monotonic()
+                self.db.purge_entitlement_changes(datetime.now() - self.CHANGE_RETENTION)
         except Exception as e:
-            logging.error(f"Get user error: {e}")
-            return None
+            with self._lock:
+                self._stats['sync_errors'] += 1
+            logging.error(f"Entitlement sync failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._entries), sync_interval=self.sync_interval)
+
+class AnswerCache:
+    """Cache of AI answers keyed on the normalized prompt and processed image.
+
+    A bounded in-memory LRU sits in front of an optional shared tier in the
+    ``answer_cache`` table, so a question any worker has answered before is
+    served without calling the AI API. Both tiers expire entries after ``ttl``.
+    """
+
+    def __init__(self, database=None, max_entries=1000, ttl=7 * 24 * 3600, purge_interval=3600):
+        self.db = database  # None disables the shared tier
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._entries = OrderedDict()  # key -> (response, expires_at)
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._stats = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(prompt, image_base64=None):
+        """Hash of the case/whitespace-normalized prompt plus the processed image bytes"""
+        normalized = ' '.join(prompt.lower().split())
+        digest = hashlib.sha256(normalized.encode('utf-8'))
+        if image_base64:
+            digest.update(b'\0' + hashlib.sha256(image_base64.encode('ascii')).digest())
+        return digest.hexdigest()
+
+    def _remember(self, key, response):
+        with self._lock:
+            self._entries[key] = (response, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+        
+        if self.db is not None:
+            response = self.db.get_cached_answer(key, datetime.now() - timedelta(seconds=self.ttl))
+            if response is not None:
+                self._remember(key, response)
+                with self._lock:
+                    self._stats['shared_hits'] += 1
+                return response
+        
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def set(self, key, response):
+        self._remember(key, response)
+        if self.db is None:
+            return
+        self.db.store_cached_answer(key, response)
+        
+        # Expired shared rows are only ever skipped by get(), so sweep them now and then
+        with self._lock:
+            purge_due = time.monotonic() - self._last_purge > self.purge_interval
+            if purge_due:
+                self._last_purge = time.monotonic()
+        if purge_due:
+            self.db.purge_cached_answers(datetime.now() - timedelta(seconds=self.ttl))
+
+    def stats(self):
+        with self._lock:
+            hits = self._stats['memory_hits'] + self._stats['shared_hits']
+            lookups = hits + self._stats['misses']
+            return dict(self._stats,
+                        size=len(self._entries),
+                        max_entries=self.max_entries,
+                        hit_ratio=round(hits / lookups, 3) if lookups else 0.0)
+
+class SingleFlight:
+    """Share one in-flight call among concurrent callers with the same key.
+
+    The first caller for a key runs the call; callers arriving while it is
+    still running wait for its result (or its exception) instead of making
+    their own. Streamed tokens are relayed to every caller, with a late
+    joiner first replayed what has already arrived. Only calls in this
+    worker are shared.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.chunks = []
+            self.listeners = []
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, func, on_token=None):
+        """Return (func's result, shared), where shared means another caller ran it.
+
+        ``func`` is called with a token callback when ``on_token`` is given,
+        or None when not.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+                self._stats['calls'] += 1
+            else:
+                self._stats['shared'] += 1
+            if on_token:
+                # Replayed under the lock so no token is missed or repeated
+                for text in call.chunks:
+                    on_token(text)
+                call.listeners.append(on_token)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(self._relay(call) if on_token else None)
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
         finally:
-            if cursor:
-                cursor.close()
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
 
-    def get_user_subscription(self, user_id):
-        cursor = None
+    def _relay(self, call):
+        def on_token(text):
+            with self._lock:
+                call.chunks.append(text)
+                listeners = list(call.listeners)
+            for listener in listeners:
+                listener(text)
+        return on_token
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._calls))
+
+class ConcurrencyLimiter:
+    """Cap concurrent upstream calls; callers wait up to ``timeout`` for a slot, then fail fast"""
+
+    def __init__(self, limit, timeout=20):
+        self.limit = limit
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._stats = {'in_flight': 0, 'waiting': 0, 'rejected': 0}
+        self.waits = LatencyHistogram()
+
+    @contextmanager
+    def slot(self):
+        started = time.monotonic()
+        with self._lock:
+            self._stats['waiting'] += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        self.waits.observe(time.monotonic() - started)
+        with self._lock:
+            self._stats['waiting'] -= 1
+            if not acquired:
+                self._stats['rejected'] += 1
+            else:
+                self._stats['in_flight'] += 1
+        if not acquired:
+            raise RuntimeError("We're answering a lot of questions right now. Please try again in a minute.")
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT plan_type, end_date FROM subscriptions 
-            WHERE user_id = %s AND is_active = TRUE AND end_date > CURRENT_TIMESTAMP
-            ORDER BY end_date DESC LIMIT 1
-            ''', (user_id,))
-            return cursor.fetchone()
+            yield
+        finally:
+            with self._lock:
+                self._stats['in_flight'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, limit=self.limit, wait=self.waits.snapshot())
+
+class AnswerQueue:
+    """Bounded worker pool that answers questions off the request thread.
+
+    ``/ask`` submits a job and returns immediately; a worker calls the AI API,
+    stores the answer through ``Database.record_question`` and marks the job
+    done. Job state is mirrored to the ``answer_jobs`` table so a status poll
+    that lands on a different gunicorn worker still finds it. With streaming
+    enabled, tokens are buffered on the job as they arrive so ``follow()`` can
+    relay them to the browser before the answer is complete. Identical
+    questions in flight at once share one API call, and ``limiter`` caps the
+    calls made at once.
+    """
+
+    def __init__(self, database, cache=None, workers=4, max_pending=50, job_ttl=600, streaming=True,
+                 limiter=None):
+        self.db = database
+        self.cache = cache
+        self.streaming = streaming
+        self.flights = SingleFlight()
+        self.limiter = limiter
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ai-worker')
+        self.max_pending = max_pending
+        self.job_ttl = job_ttl
+        self._jobs = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.job_ttl
+        for job_id in [j for j, job in self._jobs.items()
+                       if job['status'] in ('completed', 'failed') and job['finished'] < cutoff]:
+            del self._jobs[job_id]
+
+    def _set(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+            self._changed.notify_all()
+        self.db.update_job(job_id, fields['status'],
+                           question_id=fields.get('question_id'), error=fields.get('error'))
+
+    def submit(self, user_id, question_type, content, image_path, prompt, image_base64, cost,
+               payment_id=None, cache_key=None, check_cache=False, max_tokens=1000, prompt_tokens=None):
+        with self._lock:
+            self._prune()
+            if self._pending >= self.max_pending:
+                raise RuntimeError("We're answering a lot of questions right now. Please try again in a minute.")
+            self._pending += 1
+            job_id = secrets.token_urlsafe(16)
+            self._jobs[job_id] = {'user_id': user_id, 'status': 'queued', 'response': None,
+                                  'error': None, 'finished': None, 'chunks': []}
+        try:
+            self.db.create_job(job_id, user_id)
+            self.executor.submit(self._run, job_id, user_id, question_type, content, image_path,
+                                 prompt, image_base64, cost, payment_id, cache_key, check_cache,
+                                 max_tokens, prompt_tokens)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                del self._jobs[job_id]
+            raise
+        return job_id
+
+    def _run(self, job_id, user_id, question_type, content, image_path, prompt, image_base64, cost,
+             payment_id, cache_key, check_cache, max_tokens, prompt_tokens):
+        try:
+            self._set(job_id, status='running')
+            ai_response = None
+            # Answers from the cache cost no tokens
+            usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+            if check_cache and self.cache and cache_key:
+                ai_response = self.cache.get(cache_key)
+            if ai_response is None:
+                on_token = (lambda text: self._append(job_id, text)) if self.streaming else None
+                call = lambda relay: self._ask(prompt, image_base64, relay, max_tokens)
+                if cache_key:
+                    (ai_response, usage), shared = self.flights.do(cache_key, call, on_token)
+                else:
+                    (ai_response, usage), shared = call(on_token), False
+                if shared:
+                    # The job that made the call records its tokens and caches the answer
+                    usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+                else:
+                    if usage is None:
+                        usage = {'prompt_tokens': prompt_tokens or RequestPlanner.estimate_tokens(prompt),
+                                 'completion_tokens': RequestPlanner.estimate_tokens(ai_response)}
+                    if self.cache and cache_key:
+                        self.cache.set(cache_key, ai_response)
+            question_id = self.db.record_question(
+                user_id=user_id,
+                question_type=question_type,
+                content=content,
+                image_path=image_path,
+                response=ai_response,
+                cost=cost,
+                payment_id=payment_id,
+                prompt_tokens=usage['prompt_tokens'],
+                completion_tokens=usage['completion_tokens']
+            )
+            self._set(job_id, status='completed', response=ai_response,
+                      question_id=question_id, finished=time.monotonic())
         except Exception as e:
-            logging.error(f"Get subscription error: {e}")
-            return None
+            logging.error(f"Answer job {job_id} failed: {e}")
+            error = str(e) if isinstance(e, RuntimeError) else "Failed to process question. Please try again."
+            self._set(job_id, status='failed', error=error, finished=time.monotonic())
         finally:
-            if cursor:
-                cursor.close()
+            with self._lock:
+                self._pending -= 1
 
-    def create_subscription(self, user_id, plan_type, payment_id=None):
-        start_date = datetime.now()
-        end_date = start_date + timedelta(days=30) if plan_type == "monthly" else None
-        cursor = None
+    def _ask(self, prompt, image_base64, on_token, max_tokens):
+        if self.limiter is None:
+            return get_ai_response(prompt, image_base64, on_token=on_token, max_tokens=max_tokens)
+        with self.limiter.slot():
+            return get_ai_response(prompt, image_base64, on_token=on_token, max_tokens=max_tokens)
+
+    def _append(self, job_id, text):
+        with self._lock:
+            self._jobs[job_id]['chunks'].append(text)
+            self._changed.notify_all()
+
+    def follow(self, job_id, timeout=25):
+        """Yield (event, data) pairs for a job as its answer streams in.
+
+        Emits ``token`` events with new text, then ``completed`` or ``failed``.
+        If the job lives on another worker, or outlasts ``timeout``, a
+        ``pending`` event tells the client to fall back to polling.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
         
-        try:
-            cursor = self.conn.cursor()
-            # Deactivate any existing subscriptions
-            cursor.execute('''
-            UPDATE subscriptions 
-            SET is_active = FALSE 
-            WHERE user_id = %s AND is_active = TRUE
-            ''', (user_id,))
-            
-            # Create new subscription
-            cursor.execute('''
-            INSERT INTO subscriptions (user_id, plan_type, start_date, end_date, payment_id)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-            ''', (user_id, plan_type, start_date, end_date, payment_id))
+        if job is None:
+            stored = self.db.get_job(job_id)
+            if stored and stored[1] == 'completed':
+                yield 'completed', {"response": stored[3]}
+            elif stored and stored[1] == 'failed':
+                yield 'failed', {"error": stored[2]}
+            else:
+                yield 'pending', {}
+            return
+        
+        sent = 0
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._changed:
+                while len(job['chunks']) == sent and job['status'] in ('queued', 'running'):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+                new_text = ''.join(job['chunks'][sent:])
+                sent = len(job['chunks'])
+                status, error, response = job['status'], job['error'], job['response']
             
-            sub_id = cursor.fetchone()[0]
-            self.conn.commit()
-            return sub_id
+            if new_text:
+                yield 'token', {"text": new_text}
+            if status == 'completed':
+                yield 'completed', {"response": response}
+                return
+            if status == 'failed':
+                yield 'failed', {"error": error}
+                return
+            if time.monotonic() >= deadline:
+                yield 'pending', {}
+                return
+
+    def get(self, job_id):
+        """Return (user_id, status, error, response) or None, like Database.get_job"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return job['user_id'], job['status'], job['error'], job['response']
+        return self.db.get_job(job_id)
+
+    def stats(self):
+        with self._lock:
+            stats = {'pending': self._pending, 'max_pending': self.max_pending}
+        stats['coalescing'] = self.flights.stats()
+        stats['upstream'] = self.limiter.stats() if self.limiter else None
+        return stats
+
+class BlobStore:
+    """Content-addressed file store for uploads.
+
+    Files are named by the SHA-256 of their bytes and sharded two levels deep
+    (``ab/cd/abcd...``), so identical uploads share one file and no upload can
+    overwrite another. Derived files (e.g. the processed JPEG) live next to
+    the original under the same digest with a suffix.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def is_digest(value):
+        return bool(value) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+    def path(self, digest, suffix=''):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + suffix)
+
+    def read(self, digest, suffix=''):
+        try:
+            with open(self.path(digest, suffix), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, digest, data, suffix=''):
+        """Store data under digest unless already present; returns True if written"""
+        path = self.path(digest, suffix)
+        if os.path.exists(path):
+            # A fresh upload of old content must not look stale to the sweep
+            try:
+                os.utime(path)
+                return False
+            except FileNotFoundError:
+                pass  # Swept in between; write it again
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a partial file
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def iter_blobs(self):
+        """Yield (digest, file paths, newest mtime) for every stored blob"""
+        if not os.path.isdir(self.root):
+            return
+        for shard in sorted(os.listdir(self.root)):
+            shard_path = os.path.join(self.root, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_path):
+                continue
+            for sub in sorted(os.listdir(shard_path)):
+                sub_path = os.path.join(shard_path, sub)
+                if not os.path.isdir(sub_path):
+                    continue
+                blobs = {}
+                for name in os.listdir(sub_path):
+                    digest = name[:64]
+                    if self.is_digest(digest):
+                        blobs.setdefault(digest, []).append(os.path.join(sub_path, name))
+                for digest, paths in blobs.items():
+                    yield digest, paths, max(os.path.getmtime(p) for p in paths)
+
+class ImagePipeline:
+    """Preprocess uploads from memory in a process pool.
+
+    Uploads are never written to disk before processing: the request hands
+    the raw bytes to a worker process (so resizing and re-encoding don't hold
+    this process's GIL), and the original is persisted on a background thread.
+    The processed base64 JPEG is stored next to the original in the blob
+    store, so re-uploading the same image skips processing entirely. Each
+    size and quality the planner asks for is kept as its own variant.
+    Per-stage timings are kept in latency histograms.
+    """
+    STAGES = ('queue', 'decode', 'resize', 'encode', 'total')
+
+    def __init__(self, store, workers=2, timeout=30):
+        self.store = store
+        self.timeout = timeout
+        self.executor = None
+        if workers:
+            # forkserver/spawn children import only the imaging module, never a forked copy of our threads
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        elif COOPERATIVE:
+            # Inline work would stall every greenlet in the worker; a native thread only holds the GIL
+            self.executor = native_executor(1, 'image-inline')
+        self.writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='upload-writer')
+        self.timings = {stage: LatencyHistogram() for stage in self.STAGES}
+        self._processed_hits = 0
+
+    @staticmethod
+    def processed_suffix(max_dimension, quality):
+        return f'.{max_dimension}q{quality}.b64'
+
+    @traced('image', 'process_image')
+    def process(self, image_bytes, max_dimension=imaging.MAX_DIMENSION, quality=imaging.JPEG_QUALITY):
+        """Return the upload as a resized base64 JPEG for the AI request"""
+        started = time.monotonic()
+        try:
+            if self.executor:
+                future = self.executor.submit(imaging.process_image, image_bytes, max_dimension, quality)
+                image_base64, stages = future.result(timeout=self.timeout)
+            else:
+                image_base64, stages = imaging.process_image(image_bytes, max_dimension, quality)
         except Exception as e:
-            self.conn.rollback()
-            logging.error(f"Create subscription error: {e}")
-            raise RuntimeError("Failed to create subscription")
-        finally:
-            if cursor:
-                cursor.close()
+            logging.error(f"Image processing failed: {e}")
+            raise RuntimeError("Failed to process image")
+        
+        total = time.monotonic() - started
+        stages['queue'] = max(total - sum(stages.values()), 0.0)
+        stages['total'] = total
+        for stage, seconds in stages.items():
+            self.timings[stage].observe(seconds)
+        return image_base64
+
+    def _persist(self, digest, image_bytes, image_base64, suffix):
+        try:
+            self.store.write(digest, image_bytes)
+            self.store.write(digest, image_base64.encode('ascii'), suffix)
+        except OSError as e:
+            logging.error(f"Saving upload {digest} failed: {e}")
+
+    def ingest(self, image_bytes, max_dimension=imaging.MAX_DIMENSION, quality=imaging.JPEG_QUALITY):
+        """Store an upload and return (digest, base64 JPEG), reusing a cached processed copy"""
+        digest = self.store.digest(image_bytes)
+        suffix = self.processed_suffix(max_dimension, quality)
+        processed = self.store.read(digest, suffix)
+        if processed is not None:
+            self._processed_hits += 1
+            return digest, processed.decode('ascii')
+        
+        image_base64 = self.process(image_bytes, max_dimension, quality)
+        # Persist without making the request wait on disk
+        self.writer.submit(self._persist, digest, image_bytes, image_base64, suffix)
+        return digest, image_base64
+
+    def load(self, digest, max_dimension=imaging.MAX_DIMENSION, quality=imaging.JPEG_QUALITY):
+        """Return the base64 JPEG for an image already in the blob store"""
+        processed = self.store.read(digest, self.processed_suffix(max_dimension, quality))
+        if processed is not None:
+            return processed.decode('ascii')
+        original = self.store.read(digest)
+        if original is None:
+            raise RuntimeError("Uploaded image is no longer available")
+        return self.ingest(original, max_dimension, quality)[1]
+
+    def stats(self):
+        return {
+            'processed_cache_hits': self._processed_hits,
+            'stages': {stage: histogram.snapshot() for stage, histogram in self.timings.items()}
+        }
+
+class RequestPlanner:
+    """Size each AI request to its question instead of sending one fixed shape.
+
+    A typed question is tidied (whitespace collapsed, long lines pasted more
+    than once dropped) and trimmed to ``max_prompt_tokens``; its answer budget
+    grows with its length between the profile's floor and ``max_tokens``. A
+    photo with a typed question only supports the text, so it is sent smaller
+    than a photo that is the whole question. Tokens are estimated at about
+    four characters each, which is close enough for budgeting; the counts
+    the API reports are what get recorded.
+    """
+    CHARS_PER_TOKEN = 4
+    # Shorter repeated lines ("x = 2", "True") are often legitimately repeated
+    MIN_DEDUPE_LENGTH = 20
+    PROFILES = {
+        'text': {'min_tokens': 300, 'tokens_per_input': 4},
+        'image_text': {'min_tokens': 400, 'tokens_per_input': 4, 'image_dimension': 768, 'image_quality': 70},
+        'image': {'min_tokens': 700, 'tokens_per_input': 0, 'image_dimension': imaging.MAX_DIMENSION, 'image_quality': 80},
+    }
+
+    def __init__(self, max_tokens=1000, max_prompt_tokens=1500):
+        self.max_tokens = max_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self._stats = {'planned': 0, 'trimmed': 0, 'deduped_lines': 0, 'chars_saved': 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def estimate_tokens(cls, text):
+        return math.ceil(len(text or '') / cls.CHARS_PER_TOKEN)
+
+    @staticmethod
+    def estimate_image_tokens(max_dimension):
+        # Vision models bill a base cost plus a share per 512px tile
+        tiles = math.ceil(max_dimension / 512) ** 2
+        return 85 + 170 * tiles
+
+    def compact(self, question):
+        """Return (question, lines dropped, trimmed?) with whitespace and repeats removed"""
+        lines, seen, dropped = [], set(), 0
+        for line in (question or '').splitlines():
+            line = ' '.join(line.split())
+            if not line:
+                if lines and lines[-1]:
+                    lines.append('')
+                continue
+            key = line.casefold()
+            if len(line) >= self.MIN_DEDUPE_LENGTH and key in seen:
+                dropped += 1
+                continue
+            seen.add(key)
+            lines.append(line)
+        text = '\n'.join(lines).strip()
+
+        limit = self.max_prompt_tokens * self.CHARS_PER_TOKEN
+        trimmed = len(text) > limit
+        if trimmed:
+            text = text[:limit].rsplit(None, 1)[0] + ' ...'
+        return text, dropped, trimmed
+
+    def profile_for(self, question_type, question):
+        if question_type == 'image':
+            return 'image_text' if (question or '').strip() else 'image'
+        return 'text'
+
+    def plan(self, question_type, question):
+        """Decide how to send a question.
+
+        Returns a dict with the compacted ``question``, the ``max_tokens``
+        to request, the ``image_dimension``/``image_quality`` to send any
+        photo at (None for text), and the estimated ``prompt_tokens``.
+        """
+        name = self.profile_for(question_type, question)
+        profile = self.PROFILES[name]
+        text, dropped, trimmed = self.compact(question)
+
+        question_tokens = self.estimate_tokens(text)
+        prompt_tokens = self.estimate_tokens(build_prompt(text))
+        dimension = profile.get('image_dimension')
+        if dimension:
+            prompt_tokens += self.estimate_image_tokens(dimension)
+        max_tokens = min(self.max_tokens,
+                         max(profile['min_tokens'], profile['tokens_per_input'] * question_tokens))
+
+        with self._lock:
+            self._stats['planned'] += 1
+            self._stats['trimmed'] += trimmed
+            self._stats['deduped_lines'] += dropped
+            self._stats['chars_saved'] += max(len(question or '') - len(text), 0)
+        return {
+            'profile': name,
+            'question': text,
+            'max_tokens': max_tokens,
+            'image_dimension': dimension,
+            'image_quality': profile.get('image_quality'),
+            'prompt_tokens': prompt_tokens,
+        }
+
+    def image_variants(self):
+        """Every (dimension, quality) an image may be processed at"""
+        return {(p['image_dimension'], p['image_quality']) for p in self.PROFILES.values() if 'image_dimension' in p}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, max_tokens=self.max_tokens, max_prompt_tokens=self.max_prompt_tokens)
+
+class RateLimiter:
+    """Token buckets per key: ``limit`` attempts per ``period`` seconds, refilled smoothly.
+
+    Buckets live in this worker's memory, so with N gunicorn workers an
+    attacker gets at most N times the limit; the point is to refuse a
+    burst before it costs any hashing.
+    """
+
+    def __init__(self, limit, period, max_keys=10000):
+        self.capacity = limit
+        self.rate = limit / period
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, last refill)
+        self._lock = threading.Lock()
+        self._stats = {'allowed': 0, 'rejected': 0}
 
-    def create_payment(self, user_id, amount, phone_number):
-        cursor = None
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            INSERT INTO payments (user_id, amount, phone_number, transaction_date)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-            ''', (user_id, amount, phone_number, datetime.now()))
-            
-            payment_id = cursor.fetchone()[0]
-            self.conn.commit()
-            return payment_id
-        except Exception as e:
-            self.conn.rollback()
-            logging.error(f"Create payment error: {e}")
-            raise RuntimeError("Failed to create payment record")
-        finally:
-            if cursor:
-                cursor.close()
+    def take(self, key):
+        """Spend a token for key; 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            self._stats['rejected' if wait else 'allowed'] += 1
+            return wait
 
-    def update_payment(self, payment_id, mpesa_receipt, status='completed'):
-        cursor = None
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            UPDATE payments 
-            SET mpesa_receipt = %s, status = %s, transaction_date = %s
-            WHERE id = %s
-            ''', (mpesa_receipt, status, datetime.now(), payment_id))
-            
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            logging.error(f"Update payment error: {e}")
-            raise RuntimeError("Failed to update payment")
-        finally:
-            if cursor:
-                cursor.close()
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, keys=len(self._buckets))
 
-    def record_question(self, user_id, question_type, content, image_path, response, cost, payment_id=None):
-        cursor = None
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            INSERT INTO questions (user_id, question_type, content, image_path, response, cost, payment_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-            ''', (user_id, question_type, content, image_path, response, cost, payment_id))
-            
-            question_id = cursor.fetchone()[0]
-            self.conn.commit()
-            return question_id
-        except Exception as e:
-            self.conn.rollback()
-            logging.error(f"Record question error: {e}")
-            raise RuntimeError("Failed to record question")
-        finally:
-            if cursor:
-                cursor.close()
+class PasswordHasher:
+    """Runs the deliberately slow password KDF on a small dedicated pool.
 
-    def get_user_questions(self, user_id, limit=10):
-        cursor = None
-        try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT id, question_type, content, image_path, response, timestamp, cost 
-            FROM questions 
-            WHERE user_id = %s
-            ORDER BY timestamp DESC
-            LIMIT %s
-            ''', (user_id, limit))
-            
-            return cursor.fetchall()
-        except Exception as e:
-            logging.error(f"Get questions error: {e}")
-            return []
-        finally:
-            if cursor:
-                cursor.close()
+    At most ``workers`` hashes run at once and ``max_pending`` more may
+    wait; beyond that, or after ``timeout`` seconds of waiting, sign-ins
+    are refused instead of tying up every request thread. Hashes made with another method or cost are reported
+    by needs_rehash so they can be upgraded on the next login.
+    """
+
+    def __init__(self, method='scrypt', workers=2, max_pending=16, timeout=10):
+        self.method = method
+        self.timeout = timeout
+        self.executor = native_executor(workers, 'password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self._stats = {'rejected': 0, 'timed_out': 0, 'rehashed': 0}
+        self.timings = {'hash': LatencyHistogram(), 'verify': LatencyHistogram()}
+        # Werkzeug expands defaults (scrypt -> scrypt:32768:8:1), so learn the stored prefix once
+        self._prefix = self.executor.submit(lambda: generate_password_hash('', method).split('$', 1)[0])
 
-    def get_user_payments(self, user_id, limit=10):
-        cursor = None
+    def _timed(self, kind, func, *args):
+        start = time.perf_counter()
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-            SELECT id, amount, mpesa_receipt, status, transaction_date 
-            FROM payments 
-            WHERE user_id = %s
-            ORDER BY transaction_date DESC
-            LIMIT %s
-            ''', (user_id, limit))
-            
-            return cursor.fetchall()
-        except Exception as e:
-            logging.error(f"Get payments error: {e}")
-            return []
+            return func(*args)
         finally:
-            if cursor:
-                cursor.close()
+            self.timings[kind].observe(time.perf_counter() - start)
 
-class MpesaGateway:
-    def __init__(self):
-        self.consumer_key = os.getenv('MPESA_CONSUMER_KEY')
-        self.consumer_secret = os.getenv('MPESA_CONSUMER_SECRET')
-        self.business_shortcode = os.getenv('MPESA_BUSINESS_SHORTCODE')
-        self.passkey = os.getenv('MPESA_PASSKEY')
-        self.callback_url = os.getenv('MPESA_CALLBACK_URL')
-        self.access_token = None
-        self.token_expiry = None
-        
-    def get_access_token(self):
-        if self.access_token and datetime.now() < self.token_expiry:
-            return self.access_token
-            
-        auth_url = 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-        auth = (self.consumer_key, self.consumer_secret)
-        
-        try:
-            response = requests.get(auth_url, auth=auth, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            self.access_token = data['access_token']
-            self.token_expiry = datetime.now() + timedelta(seconds=data['expires_in'] - 60)
-            return self.access_token
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Failed to get M-Pesa access token: {e}")
-            raise RuntimeError("M-Pesa authentication failed")
+    def _reject(self, reason):
+        with self._lock:
+            self._stats[reason] += 1
+        raise RuntimeError("We're handling a lot of sign-ins right now. Please try again in a moment.")
 
-    def stk_push(self, phone_number, amount, account_reference, description):
-        token = self.get_access_token()
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password = base64.b64encode(
-            f"{self.business_shortcode}{self.passkey}{timestamp}".encode()
-        ).decode()
-        
-        payload = {
-            "BusinessShortCode": self.business_shortcode,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": amount,
-            "PartyA": phone_number,
-            "PartyB": self.business_shortcode,
-            "PhoneNumber": phone_number,
-            "CallBackURL": f"{self.callback_url}/callback",
-            "AccountReference": account_reference,
-            "TransactionDesc": description
-        }
-        
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
-        
+    def _run(self, kind, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self._reject('rejected')
+        future = self.executor.submit(self._timed, kind, func, *args)
+        future.add_done_callback(lambda _: self._slots.release())
         try:
-            response = requests.post(
-                'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest',
-                headers=headers,
-                json=payload,
-                timeout=15
-            )
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            logging.error(f"STK push failed: {e}")
-            raise RuntimeError("Payment request failed")
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            # The hash still finishes and frees its slot; this request stops waiting
+            self._reject('timed_out')
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, stored_hash, password):
+        return self._run('verify', check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        return stored_hash.split('$', 1)[0] != self._prefix.result()
+
+    def record_rehash(self):
+        with self._lock:
+            self._stats['rehashed'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['timings'] = {kind: histogram.snapshot() for kind, histogram in self.timings.items()}
+        return stats
+
+def create_session_interface(backend):
+    """Session storage for SESSION_BACKEND.
+
+    ``cookie`` keeps the (tiny) session in a signed cookie and needs no
+    storage at all; ``database`` shares server-side sessions through the
+    Database; ``filesystem`` is the original Flask-Session file store.
+    """
+    if backend == 'cookie':
+        return SecureCookieSessionInterface()
+    if backend == 'database':
+        return DatabaseSessionInterface(db)
+    if backend == 'filesystem':
+        return Session()._get_interface(app)
+    raise RuntimeError(f"Unknown SESSION_BACKEND: {backend}")
 
 # Initialize services
-db = Database()
-mpesa = MpesaGateway()
+span_metrics = SpanMetrics()
+instrument(Database, 'db')
+if COOPERATIVE and app.config['PROFILE_SLOW_REQUESTS']:
+    # sys._current_frames() only sees OS threads, not the greenlets serving requests
+    logging.warning("PROFILE_SLOW_REQUESTS is ignored under gevent workers")
+    app.config['PROFILE_SLOW_REQUESTS'] = 0
+profiler = (SamplingProfiler(app.config['PROFILE_SLOW_REQUESTS'],
+                             interval=app.config['PROFILE_INTERVAL'],
+                             sample_rate=app.config['PROFILE_SAMPLE_RATE'])
+            if app.config['PROFILE_SLOW_REQUESTS'] else None)
+db = Database(archive=BlobStore(app.config['ARCHIVE_FOLDER']))
+http_client = HttpClient(
+    pool_maxsize=app.config['HTTP_POOL_SIZE'],
+    retries=app.config['HTTP_RETRIES'],
+    backoff=app.config['HTTP_BACKOFF'],
+    failure_threshold=app.config['CIRCUIT_FAILURE_THRESHOLD'],
+    reset_timeout=app.config['CIRCUIT_RESET_TIMEOUT']
+)
+mpesa = MpesaGateway(http_client, db, app.config['MPESA_CALLBACK_TOKEN'])
+blob_store = BlobStore(app.config['UPLOAD_FOLDER'])
+image_pipeline = ImagePipeline(blob_store, workers=app.config['IMAGE_WORKERS'])
+request_planner = RequestPlanner(
+    max_tokens=app.config['AI_MAX_TOKENS'],
+    max_prompt_tokens=app.config['AI_MAX_PROMPT_TOKENS']
+)
+app.session_interface = create_session_interface(app.config['SESSION_BACKEND'])
+password_hasher = PasswordHasher(
+    method=app.config['PASSWORD_HASH_METHOD'],
+    workers=app.config['HASH_WORKERS'],
+    max_pending=app.config['HASH_MAX_PENDING']
+)
+login_username_limiter = RateLimiter(app.config['LOGIN_USERNAME_LIMIT'], app.config['LOGIN_LIMIT_PERIOD'])
+if app.config['TRUSTED_PROXIES']:
+    login_ip_limiter = RateLimiter(app.config['LOGIN_IP_LIMIT'], app.config['LOGIN_LIMIT_PERIOD'])
+else:
+    # Behind a router without TRUSTED_PROXIES every client shares the router's address
+    logging.warning("TRUSTED_PROXIES is not set; login attempts are only limited per username, not per client IP")
+    login_ip_limiter = None
+dashboard_cache = DashboardCache(max_entries=app.config['DASHBOARD_CACHE_SIZE'])
+fragment_cache = FragmentCache(max_entries=app.config['FRAGMENT_CACHE_SIZE'])
+entitlement_cache = EntitlementCache(
+    db,
+    max_entries=app.config['ENTITLEMENT_CACHE_SIZE'],
+    ttl=app.config['ENTITLEMENT_CACHE_TTL'],
+    sync_interval=app.config['ENTITLEMENT_SYNC_INTERVAL']
+)
+answer_cache = AnswerCache(
+    db if app.config['ANSWER_CACHE_SHARED'] else None,
+    max_entries=app.config['ANSWER_CACHE_SIZE'],
+    ttl=app.config['ANSWER_CACHE_TTL']
+)
+answer_queue = AnswerQueue(
+    db,
+    cache=answer_cache,
+    streaming=app.config['AI_STREAMING'],
+    workers=app.config['AI_WORKERS'],
+    max_pending=app.config['AI_MAX_PENDING'],
+    limiter=(ConcurrencyLimiter(app.config['AI_MAX_IN_FLIGHT'], timeout=app.config['AI_SLOT_TIMEOUT'])
+             if app.config['AI_MAX_IN_FLIGHT'] else None)
+)
+
+# Signalled when a payment callback lands, to wake long-polling status requests
+payment_updates = threading.Condition()
 
 # Pricing configuration
+HISTORY_PAGE_SIZE = 10
+HISTORY_MAX_PAGE_SIZE = 100
+
 PRICING = {
     "pay_per_use": {"price": 10, "currency": "KES", "name": "Pay-per-Use"},
     "monthly": {"price": 500, "currency": "KES", "name": "Monthly Subscription"}
 }
 
+# Fingerprinted static assets; templates link them through asset_url()
+try:
+    asset_manifest = (assets.build(app.static_folder) if app.config['ASSET_BUILD']
+                      else assets.load_manifest(app.static_folder))
+except OSError as e:
+    logging.error(f"Static asset build failed, serving unbuilt assets: {e}")
+    asset_manifest = assets.load_manifest(app.static_folder)
+built_assets = set(asset_manifest.values())
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+def warm_templates(env):
+    """Compile every template now rather than on a request; returns a hash of their sources"""
+    digest = hashlib.sha256()
+    for name in env.list_templates():
+        try:
+            source = env.loader.get_source(env, name)[0]
+            env.get_template(name)
+        except Exception as e:
+            logging.error(f"Template {name} failed to compile: {e}")
+            continue
+        digest.update(name.encode('utf-8') + b'\0' + source.encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+# Compiled bytecode is shared through the cache dir, so later workers only unmarshal it
+if app.config['TEMPLATE_CACHE_DIR']:
+    os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+# Part of every fragment key and ETag: a deploy changing templates or assets invalidates both
+RENDER_VERSION = hashlib.sha256(
+    (warm_templates(app.jinja_env) + json.dumps(asset_manifest, sort_keys=True)).encode('utf-8')).hexdigest()[:12]
+
+# Request instrumentation
+@app.before_request
+def start_request_spans():
+    g.spans = []
+    g.request_started = time.perf_counter()
+    g.profiling = profiler.start() if profiler else False
+
+@before_render_template.connect_via(app)
+def start_template_span(sender, template, context, **extra):
+    g.setdefault('template_starts', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def end_template_span(sender, template, context, **extra):
+    starts = g.get('template_starts')
+    if starts:
+        seconds = time.perf_counter() - starts.pop()
+        span_metrics.observe('template', template.name, seconds)
+        if 'spans' in g:
+            g.spans.append(('template', template.name, seconds))
+
+@app.after_request
+def finish_request_spans(response):
+    if 'request_started' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    span_metrics.observe('request', endpoint, seconds)
+    if g.profiling:
+        path = profiler.stop(endpoint, seconds)
+        if path:
+            logging.warning("Slow request %s %s took %.3fs; profile written to %s", request.method, request.path, seconds, path)
+    
+    # Server-Timing shows the breakdown in the browser's network panel
+    totals = {}
+    for kind, _, span_seconds in g.spans:
+        totals[kind] = totals.get(kind, 0.0) + span_seconds
+    timings = [f'{kind};dur={total * 1000:.1f}' for kind, total in totals.items()]
+    response.headers['Server-Timing'] = ', '.join(timings + [f'total;dur={seconds * 1000:.1f}'])
+    return response
+
 # Helper functions
+@app.context_processor
+def inject_pricing():
+    # ask.html shows prices on every render, including its error paths
+    return {'pricing': PRICING}
+
+@app.template_global()
+def asset_url(filename):
+    """Fingerprinted URL for a static asset, or the plain static URL if it isn't built"""
+    built = asset_manifest.get(filename)
+    if built is None:
+        return url_for('static', filename=filename)
+    return url_for('static_asset', filename=built)
+
+@app.template_global()
+def fragment(name, *key, caller):
+    """Call block rendering its body once per key; see FragmentCache"""
+    return Markup(fragment_cache.render((RENDER_VERSION, request.script_root, name) + key, caller))
+
+def page_etag(*parts):
+    return hashlib.sha256(repr((RENDER_VERSION,) + parts).encode('utf-8')).hexdigest()[:20]
+
+def not_modified(etag):
+    """A 304 if the client already holds this version of the page, else None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def with_etag(body, etag):
+    """Page response browsers keep but revalidate on every view"""
+    response = app.make_response(body)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.template_filter('to_datetime')
+def to_datetime(value):
+    return parse_timestamp(value)
+
 def allowed_file(filename):
     if not filename:
         return False
@@ -449,26 +3643,193 @@ def allowed_file(filename):
     return ('.' in filename and 
             filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS'])
 
-def process_image(image_path):
+def authenticate(username, password):
+    """User id for valid credentials, else None; upgrades the stored hash if the method changed"""
+    credentials = db.get_credentials(username)
+    if not credentials:
+        return None
+    
+    user_id, stored_hash = credentials
+    if not password_hasher.verify(stored_hash, password):
+        return None
+    
+    if password_hasher.needs_rehash(stored_hash):
+        try:
+            db.update_password_hash(user_id, password_hasher.hash(password))
+            password_hasher.record_rehash()
+        except RuntimeError:
+            pass  # Busy; try again on the next login
+    return user_id
+
+def throttle_login(username=None):
+    """Seconds the client must wait before another attempt, or 0"""
+    wait = login_ip_limiter.take(request.remote_addr) if login_ip_limiter else 0
+    if username:
+        wait = max(wait, login_username_limiter.take(username.lower()))
+    return wait
+
+def too_many_attempts(template, wait):
+    wait = math.ceil(wait)
+    error = f"Too many attempts. Please try again in {wait} seconds."
+    return render_template(template, error=error), 429, {'Retry-After': str(wait)}
+
+def load_dashboard(user_id):
+    """Dashboard data for a user from the per-user cache, or one query on a miss"""
+    version = db.get_data_version(user_id)
+    if version is None:
+        return None
+    
+    data = dashboard_cache.get(user_id, version)
+    if data is None:
+        data = db.get_dashboard(user_id, limit=HISTORY_PAGE_SIZE + 1)
+        if data is None:
+            return None
+        dashboard_cache.set(user_id, data['version'], data)
+    
+    # A cached monthly plan can run out without any write to invalidate it
+    subscription = data['subscription']
+    if subscription and subscription[1] and subscription[1] <= datetime.now():
+        data = dict(data, subscription=None)
+    return data
+
+def encode_cursor(timestamp, row_id):
+    """Opaque keyset cursor for the row a history page ended on"""
+    return base64.urlsafe_b64encode(json.dumps([str(timestamp), row_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    """(timestamp, id) from encode_cursor; ValueError if it was tampered with"""
     try:
-        with Image.open(image_path) as img:
-            # Convert to RGB if needed (for PNG with transparency)
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
-            
-            # Resize if too large
-            if max(img.size) > 1024:
-                img.thumbnail((1024, 1024))
-            
-            # Optimize image quality
-            buffered = io.BytesIO()
-            img.save(buffered, format='JPEG', quality=85)
-            return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    except Exception as e:
-        logging.error(f"Image processing failed: {e}")
-        raise RuntimeError("Failed to process image")
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        parse_timestamp(timestamp)
+        return timestamp, int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def paginate(rows, limit, timestamp_index):
+    """Split ``limit + 1`` newest-first rows into (page, cursor for the next page or None)"""
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(last[timestamp_index], last[0])
+
+def format_timestamp(value):
+    return parse_timestamp(value).isoformat() if value else None
+
+def question_summary(row):
+    question_id, question_type, content, image_path, timestamp, cost, preview = row
+    return {
+        "id": question_id,
+        "question_type": question_type,
+        "content": content,
+        "preview": preview,
+        "image_url": url_for('uploaded_image', digest=image_path) if image_path else None,
+        "timestamp": format_timestamp(timestamp),
+        "cost": cost,
+        "url": url_for('question_detail', question_id=question_id)
+    }
+
+def payment_summary(row):
+    payment_id, amount, mpesa_receipt, status, transaction_date = row
+    return {
+        "id": payment_id,
+        "amount": amount,
+        "mpesa_receipt": mpesa_receipt,
+        "status": status,
+        "transaction_date": format_timestamp(transaction_date)
+    }
+
+def history_page_args():
+    """(limit, before) from ?limit=&cursor=; ValueError on bad input"""
+    limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+    return limit, decode_cursor(cursor) if cursor else None
+
+def build_prompt(question):
+    return "Explain this homework question in simple terms a parent can use to help their child: " + (question or "")
+
+def token_usage(body):
+    """The usage block of a chat completion as a dict, or None if absent"""
+    usage = body.get("usage")
+    if not usage:
+        return None
+    return {"prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)}
+
+def request_payment(user, plan, purpose, account_reference, description):
+    """Create a payment and send the STK push; returns the payment id.
 
-def get_ai_response(prompt, image_base64=None):
+    The payment stays pending until the M-Pesa callback resolves it through
+    its CheckoutRequestID.
+    """
+    user_id, phone = user[0], user[3]
+    payment_id = db.create_payment(user_id, PRICING[plan]['price'], phone,
+                                   purpose=purpose, plan_type=plan)
+    try:
+        response = mpesa.stk_push(
+            phone_number=phone,
+            amount=PRICING[plan]['price'],
+            account_reference=f"{account_reference}{payment_id}",
+            description=description
+        )
+        
+        if 'ResponseCode' not in response or response['ResponseCode'] != '0':
+            raise RuntimeError("Payment initiation failed")
+        
+        db.attach_checkout(payment_id, response['CheckoutRequestID'], response.get('MerchantRequestID'))
+        return payment_id
+    except Exception:
+        db.update_payment(payment_id, None, status='failed')
+        raise
+
+def fulfill_payment(payment_id, user_id, purpose, plan_type):
+    """Run a completed payment's follow-up; safe to repeat until it has succeeded once"""
+    if purpose == 'subscription':
+        db.create_subscription(user_id, plan_type, payment_id)
+        entitlement_cache.invalidate(user_id)
+    else:
+        release_paid_question(payment_id)
+
+def release_paid_question(payment_id):
+    """Queue the question a completed pay-per-use payment was for, at most once"""
+    # Claim first: a retried callback or the sweeper may be here at the same time
+    if not db.mark_payment_fulfilled(payment_id):
+        return
+    pending = db.get_pending_question(payment_id)
+    if not pending or pending[4]:
+        return
+    
+    user_id, question_type, content, image_path, _ = pending
+    try:
+        plan = request_planner.plan(question_type, content)
+        image_base64 = (image_pipeline.load(image_path, plan['image_dimension'], plan['image_quality'])
+                        if image_path else None)
+        prompt = build_prompt(plan['question'])
+        job_id = answer_queue.submit(
+            user_id=user_id,
+            question_type=question_type,
+            content=content,
+            image_path=image_path,
+            prompt=prompt,
+            image_base64=image_base64,
+            cost=PRICING['pay_per_use']['price'],
+            payment_id=payment_id,
+            cache_key=answer_cache.make_key(prompt, image_base64),
+            check_cache=True,
+            max_tokens=plan['max_tokens'],
+            prompt_tokens=plan['prompt_tokens']
+        )
+    except Exception:
+        db.unmark_payment_fulfilled(payment_id)
+        raise
+    db.set_pending_question_job(payment_id, job_id)
+
+@traced('ai')
+def get_ai_response(prompt, image_base64=None, on_token=None, max_tokens=1000):
+    """Return (answer, usage); with on_token, stream it and call on_token(text) per delta.
+
+    usage holds the prompt_tokens and completion_tokens the API reported,
+    or is None if it reported none.
+    """
     headers = {
         "Authorization": f"Bearer {os.getenv('DEEPSEEK_API_KEY')}",
         "Content-Type": "application/json"
@@ -486,18 +3847,45 @@ def get_ai_response(prompt, image_base64=None):
         "model": "deepseek-chat",
         "messages": messages,
         "temperature": 0.7,
-        "max_tokens": 1000
+        "max_tokens": max_tokens
     }
+    if on_token:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
     
     try:
-        response = requests.post(
-            "https://api.deepseek.com/v1/chat/completions",
+        response = http_client.post(
+            app.config['DEEPSEEK_API_URL'],
+            endpoint='deepseek.chat',
             headers=headers,
             json=payload,
-            timeout=30
+            timeout=30,
+            stream=bool(on_token)
         )
         response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
+        if not on_token:
+            body = response.json()
+            return body["choices"][0]["message"]["content"], token_usage(body)
+        
+        # Server-sent chat-completion chunks: "data: {...}" lines, then "data: [DONE]";
+        # with include_usage the last chunk carries the usage and no choices
+        parts = []
+        usage = None
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                usage = token_usage(chunk) or usage
+                choices = chunk.get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    on_token(delta)
+        return ''.join(parts), usage
     except requests.exceptions.RequestException as e:
         logging.error(f"AI API error: {e}")
         raise RuntimeError("AI service is currently unavailable. Please try again later.")
@@ -518,13 +3906,20 @@ def login():
         if not username or not password:
             return render_template('login.html', error="Username and password are required")
         
+        # Refuse floods before they cost a password hash
+        wait = throttle_login(username)
+        if wait:
+            return too_many_attempts('login.html', wait)
+        
         try:
-            user_id = db.authenticate_user(username, password)
+            user_id = authenticate(username, password)
             if user_id:
                 session['user_id'] = user_id
                 return redirect(url_for('dashboard'))
             else:
                 return render_template('login.html', error="Invalid credentials")
+        except RuntimeError as e:
+            return render_template('login.html', error=str(e)), 503
         except Exception as e:
             logging.error(f"Login error: {e}")
             return render_template('login.html', error="Login failed. Please try again.")
@@ -542,11 +3937,17 @@ def register():
         if not username or not password:
             return render_template('register.html', error="Username and password are required")
         
+        wait = throttle_login()
+        if wait:
+            return too_many_attempts('register.html', wait)
+        
         try:
-            db.add_user(username, password, email, phone)
+            db.add_user(username, password_hasher.hash(password), email, phone)
             return redirect(url_for('login'))
         except ValueError as e:
             return render_template('register.html', error=str(e))
+        except RuntimeError as e:
+            return render_template('register.html', error=str(e)), 503
         except Exception as e:
             logging.error(f"Registration error: {e}")
             return render_template('register.html', error="Registration failed. Please try again.")
@@ -560,21 +3961,45 @@ def dashboard():
     
     user_id = session['user_id']
     try:
-        user = db.get_user(user_id)
-        if not user:
+        data = load_dashboard(user_id)
+        if not data:
             session.clear()
             return redirect(url_for('login'))
         
-        subscription = db.get_user_subscription(user_id)
-        questions = db.get_user_questions(user_id)
-        payments = db.get_user_payments(user_id)
+        # Everything the page shows is a function of these, so a match skips the render
+        subscription = data['subscription']
+        now = datetime.now()
+        days_remaining = (parse_timestamp(subscription[1]) - now).days if subscription and subscription[1] else None
+        etag = page_etag('dashboard', user_id, data['version'], subscription and subscription[0], days_remaining,
+                         request.query_string)
+        cached = not_modified(etag)
+        if cached:
+            return cached
         
-        return render_template('dashboard.html', 
-                             user=user,
-                             subscription=subscription,
-                             questions=questions,
-                             payments=payments,
-                             pricing=PRICING)
+        # First pages come from the cached dashboard; older ones seek from a cursor
+        try:
+            questions_before = request.args.get('questions_before')
+            payments_before = request.args.get('payments_before')
+            questions = (db.get_user_questions(user_id, HISTORY_PAGE_SIZE + 1, decode_cursor(questions_before))
+                         if questions_before else data['questions'])
+            payments = (db.get_user_payments(user_id, HISTORY_PAGE_SIZE + 1, decode_cursor(payments_before))
+                        if payments_before else data['payments'])
+        except ValueError:
+            return redirect(url_for('dashboard'))
+        questions, questions_cursor = paginate(questions, HISTORY_PAGE_SIZE, 4)
+        payments, payments_cursor = paginate(payments, HISTORY_PAGE_SIZE, 4)
+        
+        return with_etag(render_template('dashboard.html', 
+                                         user=data['user'],
+                                         version=data['version'],
+                                         subscription=subscription,
+                                         questions=questions,
+                                         payments=payments,
+                                         questions_cursor=questions_cursor,
+                                         payments_cursor=payments_cursor,
+                                         paged=bool(questions_before or payments_before),
+                                         pricing=PRICING,
+                                         now=now), etag)
     except Exception as e:
         logging.error(f"Dashboard error: {e}")
         return render_template('error.html', message="Failed to load dashboard"), 500
@@ -599,52 +4024,76 @@ def ask_question():
         
         try:
             # Check subscription first
-            subscription = db.get_user_subscription(user_id)
+            subscription = entitlement_cache.get(user_id)
             payment_id = None
             
-            if not subscription or subscription[0] != "monthly":
-                # Process payment for non-subscribers
-                payment_id = db.create_payment(user_id, PRICING['pay_per_use']['price'], user[3])
-                response = mpesa.stk_push(
-                    phone_number=user[3],
-                    amount=PRICING['pay_per_use']['price'],
-                    account_reference=f"HW{payment_id}",
-                    description="Homework Question"
-                )
-                
-                if 'ResponseCode' not in response or response['ResponseCode'] != '0':
-                    raise RuntimeError("Payment initiation failed")
-                
-                # In production, wait for callback instead of sleeping
-                return render_template('payment_pending.html', payment_id=payment_id)
-            
             # Process question
             image_path = None
             image_base64 = None
+            question_type = "image" if image else "text"
+            plan = request_planner.plan(question_type, question)
             
             if image and allowed_file(image.filename):
-                filename = secure_filename(image.filename)
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-                image.save(image_path)
-                image_base64 = process_image(image_path)
+                # image_path holds the upload's SHA-256; see BlobStore
+                image_path, image_base64 = image_pipeline.ingest(
+                    image.read(), plan['image_dimension'], plan['image_quality'])
+            
+            if not subscription or subscription[0] != "monthly":
+                # Non-subscribers pay first; the callback queues the question once M-Pesa confirms
+                payment_id = request_payment(user, 'pay_per_use', 'question', "HW", "Homework Question")
+                db.create_pending_question(payment_id, user_id, question_type, question, image_path)
+                
+                if request.accept_mimetypes.best == 'application/json':
+                    return jsonify({
+                        "success": True,
+                        "payment_id": payment_id,
+                        "status_url": url_for('payment_status', payment_id=payment_id)
+                    }), 202
+                return render_template('payment_pending.html', payment_id=payment_id)
             
-            prompt = "Explain this homework question in simple terms a parent can use to help their child: " + (question or "")
-            ai_response = get_ai_response(prompt, image_base64)
+            prompt = build_prompt(plan['question'])
             
-            # Record question
-            question_type = "image" if image else "text"
-            db.record_question(
+            # Repeat questions are answered from the cache without an API call
+            cache_key = answer_cache.make_key(prompt, image_base64)
+            cached_response = answer_cache.get(cache_key)
+            if cached_response is not None:
+                db.record_question(
+                    user_id=user_id,
+                    question_type=question_type,
+                    content=question,
+                    image_path=image_path,
+                    response=cached_response,
+                    cost=PRICING['pay_per_use']['price'],
+                    payment_id=payment_id,
+                    prompt_tokens=0,
+                    completion_tokens=0
+                )
+                if request.accept_mimetypes.best == 'application/json':
+                    return jsonify({"success": True, "status": "completed", "response": cached_response})
+                return render_template('response.html', response=cached_response, image_path=image_path)
+            
+            # Answer in the background so this worker is free for other requests
+            job_id = answer_queue.submit(
                 user_id=user_id,
                 question_type=question_type,
                 content=question,
                 image_path=image_path,
-                response=ai_response,
+                prompt=prompt,
+                image_base64=image_base64,
                 cost=PRICING['pay_per_use']['price'],
-                payment_id=payment_id
+                payment_id=payment_id,
+                cache_key=cache_key,
+                max_tokens=plan['max_tokens'],
+                prompt_tokens=plan['prompt_tokens']
             )
             
-            return render_template('response.html', response=ai_response, image_path=image_path)
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({
+                    "success": True,
+                    "job_id": job_id,
+                    "status_url": url_for('question_status', job_id=job_id)
+                }), 202
+            return render_template('response.html', job_id=job_id, image_path=image_path)
             
         except RuntimeError as e:
             return render_template('ask.html', error=str(e))
@@ -654,6 +4103,161 @@ def ask_question():
     
     return render_template('ask.html')
 
+@app.route('/ask/answer/<job_id>')
+def question_answer(job_id):
+    """Response page for a question answered in the background, e.g. after payment"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    # A finished answer never changes, so a revalidation needs no lookup at all
+    etag = page_etag('answer', session['user_id'], job_id)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    
+    job = answer_queue.get(job_id)
+    if not job or job[0] != session['user_id']:
+        abort(404)
+    
+    _, status, error, response = job
+    if status == 'failed':
+        return render_template('ask.html', error=error)
+    page = render_template('response.html', job_id=job_id, response=response)
+    return with_etag(page, etag) if status == 'completed' else page
+
+@app.route('/ask/status/<job_id>')
+def question_status(job_id):
+    """Poll target for a queued question; cheap enough to hit every second"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    
+    job = answer_queue.get(job_id)
+    if not job or job[0] != session['user_id']:
+        return jsonify({"success": False, "error": "Question not found"}), 404
+    
+    _, status, error, response = job
+    return jsonify({
+        "success": status != 'failed',
+        "status": status,
+        "response": response if status == 'completed' else None,
+        "error": error
+    })
+
+@app.route('/ask/stream/<job_id>')
+def question_stream(job_id):
+    """Relay a queued question's answer over server-sent events as it is generated"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    
+    job = answer_queue.get(job_id)
+    if not job or job[0] != session['user_id']:
+        return jsonify({"success": False, "error": "Question not found"}), 404
+    
+    # A worker that can't hold the stream sends what it has, then tells the page to poll
+    timeout = app.config['AI_STREAM_TIMEOUT'] if app.config['LONG_POLL'] else 0
+    
+    def events():
+        for event, data in answer_queue.follow(job_id, timeout=timeout):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/questions')
+def question_history():
+    """Keyset-paginated question history; follow next_cursor for older pages"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    
+    try:
+        limit, before = history_page_args()
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid limit or cursor"}), 400
+    
+    rows = db.get_user_questions(session['user_id'], limit + 1, before)
+    page, next_cursor = paginate(rows, limit, 4)
+    return jsonify({
+        "success": True,
+        "questions": [question_summary(row) for row in page],
+        "next_cursor": next_cursor
+    })
+
+@app.route('/questions/<int:question_id>')
+def question_detail(question_id):
+    """A single question with its full response"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    
+    row = db.get_question(question_id, session['user_id'])
+    if not row:
+        return jsonify({"success": False, "error": "Question not found"}), 404
+    
+    question = question_summary(row[:4] + row[5:])
+    question["response"] = row[4]
+    return jsonify({"success": True, "question": question})
+
+@app.route('/payments')
+def payment_history():
+    """Keyset-paginated payment history; follow next_cursor for older pages"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    
+    try:
+        limit, before = history_page_args()
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid limit or cursor"}), 400
+    
+    rows = db.get_user_payments(session['user_id'], limit + 1, before)
+    page, next_cursor = paginate(rows, limit, 4)
+    return jsonify({
+        "success": True,
+        "payments": [payment_summary(row) for row in page],
+        "next_cursor": next_cursor
+    })
+
+@app.route('/uploads/<digest>')
+def uploaded_image(digest):
+    """Serve an uploaded image from the blob store by its SHA-256"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    if not BlobStore.is_digest(digest):
+        abort(404)
+    
+    data = blob_store.read(digest)
+    mimetype = 'image/png' if data and data.startswith(b'\x89PNG') else 'image/jpeg'
+    if data is None:
+        # Original still being written; a processed copy is good enough to show
+        processed = next(filter(None, (blob_store.read(digest, ImagePipeline.processed_suffix(*variant))
+                                       for variant in request_planner.image_variants())), None)
+        if processed is None:
+            abort(404)
+        data = base64.b64decode(processed)
+    
+    response = Response(data, mimetype=mimetype)
+    # Content-addressed: the bytes behind this URL can never change
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+@app.route('/assets/<path:filename>')
+def static_asset(filename):
+    """Serve a fingerprinted asset, precompressed if the client accepts it"""
+    if filename not in built_assets:
+        abort(404)
+    
+    dist = os.path.join(app.static_folder, assets.DIST_DIR)
+    encoding, suffix = next(((encoding, suffix) for encoding, suffix in ASSET_ENCODINGS
+                             if request.accept_encodings[encoding]
+                             and os.path.exists(os.path.join(dist, filename + suffix))), (None, ''))
+    response = send_from_directory(dist, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    # The name changes with the content, so browsers never need to revalidate
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/subscribe', methods=['POST'])
 def subscribe():
     if 'user_id' not in session:
@@ -669,20 +4273,12 @@ def subscribe():
         return jsonify({"success": False, "error": "Invalid plan"}), 400
     
     try:
-        payment_id = db.create_payment(user_id, PRICING[plan]['price'], user[3])
-        response = mpesa.stk_push(
-            phone_number=user[3],
-            amount=PRICING[plan]['price'],
-            account_reference=f"SUB{payment_id}",
-            description=f"{PRICING[plan]['name']} Subscription"
-        )
-        
-        if 'ResponseCode' not in response or response['ResponseCode'] != '0':
-            raise RuntimeError("Payment initiation failed")
+        payment_id = request_payment(user, plan, 'subscription', "SUB", f"{PRICING[plan]['name']} Subscription")
         
         return jsonify({
             "success": True,
-            "message": "Payment initiated. You'll be notified when completed."
+            "message": "Payment initiated. You'll be notified when completed.",
+            "status_url": url_for('payment_status', payment_id=payment_id)
         })
     except RuntimeError as e:
         return jsonify({"success": False, "error": str(e)}), 400
@@ -690,35 +4286,182 @@ def subscribe():
         logging.error(f"Subscription error: {e}")
         return jsonify({"success": False, "error": "Subscription failed"}), 500
 
-@app.route('/callback', methods=['POST'])
-def callback():
+def paid_in_full(paid, expected):
+    try:
+        return float(paid) == float(expected)
+    except (TypeError, ValueError):
+        return False
+
+@app.route('/callback/<token>', methods=['POST'])
+def callback(token):
     """Handle M-Pesa payment callback"""
+    # Only M-Pesa has the URL we gave it in the STK push
+    if not secrets.compare_digest(token, app.config['MPESA_CALLBACK_TOKEN']):
+        abort(404)
+    
     try:
         data = request.get_json()
-        logging.info(f"Received M-Pesa callback: {data}")
-        
-        # Example implementation (simplified)
-        result_code = data.get('Body', {}).get('stkCallback', {}).get('ResultCode')
-        merchant_request_id = data.get('Body', {}).get('stkCallback', {}).get('MerchantRequestID')
-        checkout_request_id = data.get('Body', {}).get('stkCallback', {}).get('CheckoutRequestID')
-        
-        if result_code == '0':
-            # Payment successful
-            # In a real app, you would:
-            # 1. Verify the callback is from M-Pesa
-            # 2. Update your database
-            # 3. Handle subscriptions if applicable
-            
-            # For demo purposes, we'll just log it
-            logging.info(f"Payment successful: {merchant_request_id}")
+        callback_log.info("Received M-Pesa callback: %s", data)
+        
+        stk_callback = data.get('Body', {}).get('stkCallback', {})
+        result_code = stk_callback.get('ResultCode')
+        checkout_request_id = stk_callback.get('CheckoutRequestID')
+        metadata = {item.get('Name'): item.get('Value')
+                    for item in stk_callback.get('CallbackMetadata', {}).get('Item', [])}
+        
+        # Daraja sends ResultCode as a number; accept the string form too
+        status = 'completed' if str(result_code) == '0' else 'failed'
+        result_desc = stk_callback.get('ResultDesc')
+        if status == 'completed':
+            expected = db.get_pending_payment_amount(checkout_request_id)
+            if expected is not None and not paid_in_full(metadata.get('Amount'), expected):
+                callback_log.warning("Payment for %s paid %s, expected %s", checkout_request_id,
+                                     metadata.get('Amount'), expected)
+                status = 'failed'
+                result_desc = f"Amount {metadata.get('Amount')} does not match {expected}"
+        payment = db.resolve_payment(
+            checkout_request_id,
+            status,
+            mpesa_receipt=metadata.get('MpesaReceiptNumber'),
+            result_desc=result_desc
+        )
+        
+        if payment is None:
+            # A retry after the follow-up failed last time: run it again
+            payment = db.get_unfulfilled_payment(checkout_request_id)
+            if payment is None:
+                # Unknown or already resolved - M-Pesa retries callbacks, so this is expected
+                callback_log.info("Ignoring callback for %s: no pending payment", checkout_request_id)
+                return jsonify({"ResultCode": 0, "ResultDesc": "Accepted"})
+            status = 'completed'
+            callback_log.warning("Retrying follow-up for completed payment %s", payment[0])
+        
+        payment_id, user_id, purpose, plan_type = payment
+        if status == 'completed':
+            callback_log.info("Payment %s completed: %s", payment_id, metadata.get('MpesaReceiptNumber'))
+            fulfill_payment(*payment)
         else:
-            logging.warning(f"Payment failed: {data}")
+            callback_log.warning("Payment %s failed: %s", payment_id, stk_callback.get('ResultDesc'))
         
+        with payment_updates:
+            payment_updates.notify_all()
         return jsonify({"ResultCode": 0, "ResultDesc": "Accepted"})
     except Exception as e:
         logging.error(f"Callback error: {e}")
         return jsonify({"ResultCode": 1, "ResultDesc": "Failed"}), 400
 
+@app.route('/payments/<int:payment_id>/status')
+def payment_status(payment_id):
+    """Payment state for the pending page; pass ?wait=N to long-poll up to N seconds where LONG_POLL allows"""
+    if 'user_id' not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    
+    wait = min(request.args.get('wait', 0, type=float), 25) if app.config['LONG_POLL'] else 0
+    deadline = time.monotonic() + wait
+    while True:
+        payment = db.get_payment_status(payment_id, session['user_id'])
+        if not payment:
+            return jsonify({"success": False, "error": "Payment not found"}), 404
+        
+        status, purpose, job_id = payment
+        remaining = deadline - time.monotonic()
+        # A paid question is only done once its answer job exists
+        waiting = status == 'pending' or (status == 'completed' and purpose == 'question' and not job_id)
+        if not waiting or remaining <= 0:
+            break
+        # Woken early by a callback on this worker; otherwise re-check the indexed row each second
+        with payment_updates:
+            payment_updates.wait(min(remaining, 1.0))
+    
+    body = {"success": status != 'failed', "status": status, "purpose": purpose}
+    if job_id:
+        body["answer_url"] = url_for('question_answer', job_id=job_id)
+    return jsonify(body)
+
+@app.route('/health')
+def health():
+    """Liveness probe that also reports connection pool metrics"""
+    return jsonify({
+        "status": "ok",
+        "cooperative": COOPERATIVE,
+        "db_pool": db.pool_stats(),
+        "answer_queue": answer_queue.stats(),
+        "answer_cache": answer_cache.stats(),
+        "upstreams": http_client.stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "request_planner": request_planner.stats(),
+        "mpesa_token": mpesa.tokens.stats(),
+        "dashboard_cache": dashboard_cache.stats(),
+        "fragment_cache": fragment_cache.stats(),
+        "entitlement_cache": entitlement_cache.stats(),
+        "auth": {
+            "password_hasher": password_hasher.stats(),
+            "login_username_limiter": login_username_limiter.stats(),
+            "login_ip_limiter": login_ip_limiter.stats() if login_ip_limiter else None
+        },
+        "profiler": profiler.stats() if profiler else None,
+        "logging": {"queued": log_handler.queue.qsize(), "dropped": log_handler.dropped},
+        "sessions": (app.session_interface.stats() if isinstance(app.session_interface, DatabaseSessionInterface)
+                     else {'backend': app.config['SESSION_BACKEND']})
+    })
+
+def rollup_counts(row):
+    counts = dict(zip(Database.ROLLUP_COUNTERS, row))
+    questions = counts['text_questions'] + counts['image_questions']
+    counts['questions'] = questions
+    counts['image_share'] = round(counts['image_questions'] / questions, 4) if questions else None
+    return counts
+
+@app.route('/admin/analytics')
+def analytics():
+    """Revenue and usage per day and plan from the rollup tables; ?days=N (default 30, at most 366)"""
+    token = app.config['ADMIN_TOKEN']
+    if not token or not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(404)
+    
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    today = datetime.now().date()
+    # DATE comes back as a date from psycopg2 and as 'YYYY-MM-DD' from SQLite
+    rows = [(str(day), plan, counts, active) for day, plan, *counts, active
+            in db.get_rollups(today - timedelta(days=days - 1))]
+    return jsonify({
+        "success": True,
+        "days": [dict(rollup_counts(counts), day=day, plan=plan, active_subscribers=active)
+                 for day, plan, counts, active in rows],
+        "active_subscribers": sum(active for day, _, _, active in rows if day == today.isoformat()),
+        "totals": {row[0]: rollup_counts(row[1:]) for row in db.get_rollup_totals(list(PRICING))}
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Span histograms and pool gauges in the Prometheus text format (this worker only)"""
+    token = app.config['METRICS_TOKEN']
+    if not token or not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(404)
+    
+    lines = [
+        '# HELP homework_span_seconds Time spent in instrumented operations.',
+        '# TYPE homework_span_seconds histogram',
+    ]
+    for (kind, name), snapshot in span_metrics.snapshot().items():
+        labels = f'kind="{kind}",name="{name}"'
+        for bound, count in snapshot['buckets'].items():
+            lines.append(f'homework_span_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'homework_span_seconds_sum{{{labels}}} {snapshot["sum"]}')
+        lines.append(f'homework_span_seconds_count{{{labels}}} {snapshot["count"]}')
+    
+    gauges = {
+        'homework_db_pool_active': db.pool_stats()['active'],
+        'homework_db_pool_idle': db.pool_stats()['idle'],
+        'homework_answer_queue_pending': answer_queue.stats()['pending'],
+        'homework_ai_in_flight': answer_queue.limiter.stats()['in_flight'] if answer_queue.limiter else 0,
+        'homework_ai_waiting': answer_queue.limiter.stats()['waiting'] if answer_queue.limiter else 0,
+    }
+    for name, value in gauges.items():
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 @app.route('/logout')
 def logout():
     session.clear()
@@ -734,6 +4477,205 @@ def internal_error(e):
     logging.error(f"Server error: {e}")
     return render_template('500.html'), 500
 
+# CLI commands
+@app.cli.command('gc-uploads')
+@click.option('--grace-hours', default=24, show_default=True,
+              help='Keep unreferenced blobs younger than this; their question may not be recorded yet.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+def gc_uploads(grace_hours, dry_run):
+    """Delete uploaded images no question or pending question refers to any more"""
+    referenced = db.get_referenced_images()
+    cutoff = time.time() - grace_hours * 3600
+    deleted = freed = 0
+    
+    for digest, paths, mtime in blob_store.iter_blobs():
+        if digest in referenced or mtime > cutoff:
+            continue
+        for path in paths:
+            freed += os.path.getsize(path)
+            if not dry_run:
+                os.remove(path)
+        deleted += 1
+    
+    action = "Would delete" if dry_run else "Deleted"
+    click.echo(f"{action} {deleted} unreferenced blobs ({freed / 1024 / 1024:.1f} MB)")
+
+@app.cli.command('purge-sessions')
+def purge_sessions():
+    """Delete expired sessions from the database session store"""
+    interface = DatabaseSessionInterface(db)
+    click.echo(f"Deleted {interface.purge()} expired sessions")
+
+@app.cli.command('archive-responses')
+@click.option('--older-than-days', default=90, show_default=True,
+              help='Move answers older than this from the database to the archive folder.')
+@click.option('--batch-size', default=500, show_default=True, help='Answers moved per transaction.')
+def archive_responses(older_than_days, batch_size):
+    """Compress answers still stored inline, then archive old ones to files"""
+    compressed = 0
+    while True:
+        rows = db.get_inline_responses(batch_size)
+        if rows:
+            db.compress_responses(rows)
+            compressed += len(rows)
+        if len(rows) < batch_size:
+            break
+    
+    archived = 0
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    while True:
+        rows = db.get_archivable_responses(cutoff, batch_size)
+        moved = []
+        for question_id, body in rows:
+            body = bytes(body)
+            # Content-addressed, so identical answers share one file
+            digest = db.archive.digest(body)
+            db.archive.write(digest, body, '.z')
+            moved.append((question_id, digest))
+        if moved:
+            db.mark_responses_archived(moved)
+            archived += len(moved)
+        if len(rows) < batch_size:
+            break
+    
+    click.echo(f"Compressed {compressed} inline answers, archived {archived} answers older than {older_than_days} days")
+
+@app.cli.command('token-report')
+@click.option('--days', default=30, show_default=True, help='Report on questions from the last N days.')
+@click.option('--top', default=20, show_default=True, help='Users to list, biggest spenders first.')
+def token_report(days, top):
+    """Report AI token spend per plan and per user"""
+    rows = db.get_token_spend(datetime.now() - timedelta(days=days))
+
+    plans = {}
+    for _, _, plan, questions, prompt_tokens, completion_tokens in rows:
+        totals = plans.setdefault(plan, [0, 0, 0])
+        totals[0] += questions
+        totals[1] += prompt_tokens
+        totals[2] += completion_tokens
+
+    click.echo(f"Token spend over the last {days} days")
+    click.echo(f"{'plan':<14}{'questions':>10}{'prompt':>12}{'completion':>12}{'per question':>14}")
+    for plan, (questions, prompt_tokens, completion_tokens) in sorted(plans.items()):
+        per_question = (prompt_tokens + completion_tokens) / questions if questions else 0
+        click.echo(f"{plan:<14}{questions:>10}{prompt_tokens:>12}{completion_tokens:>12}{per_question:>14.0f}")
+
+    click.echo(f"\nTop {min(top, len(rows))} users")
+    click.echo(f"{'user':<24}{'plan':<14}{'questions':>10}{'prompt':>12}{'completion':>12}")
+    for user_id, username, plan, questions, prompt_tokens, completion_tokens in rows[:top]:
+        click.echo(f"{f'{username} ({user_id})':<24}{plan:<14}{questions:>10}{prompt_tokens:>12}{completion_tokens:>12}")
+
+@app.cli.command('fulfill-payments')
+@click.option('--older-than-minutes', default=5, show_default=True,
+              help='Only retry payments completed at least this long ago.')
+@click.option('--batch-size', default=100, show_default=True)
+def fulfill_payments(older_than_minutes, batch_size):
+    """Re-run the subscription or answer job for paid payments whose follow-up failed"""
+    cutoff = datetime.now() - timedelta(minutes=older_than_minutes)
+    fulfilled = failed = 0
+    seen = set()
+    while True:
+        payments = [p for p in db.get_unfulfilled_payments(cutoff, batch_size) if p[0] not in seen]
+        if not payments:
+            break
+        for payment in payments:
+            seen.add(payment[0])
+            try:
+                fulfill_payment(*payment)
+                fulfilled += 1
+            except Exception as e:
+                failed += 1
+                logging.error(f"Fulfilling payment {payment[0]} failed: {e}")
+    click.echo(f"Fulfilled {fulfilled} payments, {failed} still failing")
+
+@app.cli.command('backfill-rollups')
+@click.option('--batch-size', default=1000, show_default=True, help='Source rows read per query.')
+def backfill_rollups(batch_size):
+    """Rebuild the daily and all-time usage rollups from payments, questions and subscriptions"""
+    started = time.monotonic()
+    rows = db.rebuild_rollups(batch_size)
+    click.echo(f"Rebuilt {rows} daily rollup rows in {time.monotonic() - started:.1f}s")
+
+@app.cli.command('check-query-plans')
+@click.option('--verbose', is_flag=True, help='Print every planned statement.')
+def check_query_plans(verbose):
+    """Fail if any Database query would read a table with a sequential scan"""
+    now = datetime.now()
+    calls = [
+        ('add_user', ('plan-check', 'plan-check')),
+        ('get_credentials', ('plan-check',)),
+        ('update_password_hash', (1, 'plan-check')),
+        ('get_user', (1,)),
+        ('get_data_version', (1,)),
+        ('get_dashboard', (1,)),
+        ('get_user_subscription', (1,)),
+        ('create_subscription', (1, 'monthly', 1)),
+        ('create_payment', (1, 10, '254700000000')),
+        ('update_payment', (1, 'PLANCHECK')),
+        ('attach_checkout', (1, 'ws_CO_plan_check', 'plan-check')),
+        ('resolve_payment', ('ws_CO_plan_check', 'completed', 'PLANCHECK')),
+        ('mark_payment_fulfilled', (1,)),
+        ('unmark_payment_fulfilled', (1,)),
+        ('get_unfulfilled_payment', ('ws_CO_plan_check',)),
+        ('get_unfulfilled_payments', (now,)),
+        ('get_pending_payment_amount', ('ws_CO_plan_check',)),
+        ('get_payment_status', (1, 1)),
+        ('create_pending_question', (1, 1, 'text', 'plan check', None)),
+        ('get_pending_question', (1,)),
+        ('set_pending_question_job', (1, 'plan-check')),
+        ('record_question', (1, 'text', 'plan check', None, 'answer', 10, None, 20, 200)),
+        ('get_user_questions', (1, 11, ('2026-01-01 00:00:00', 1))),
+        ('get_user_payments', (1, 11, ('2026-01-01 00:00:00', 1))),
+        ('get_question', (1, 1)),
+        ('create_job', ('plan-check', 1)),
+        ('update_job', ('plan-check', 'completed')),
+        ('get_job', ('plan-check',)),
+        ('get_cached_answer', ('plan-check', now)),
+        ('store_cached_answer', ('plan-check', 'answer')),
+        ('purge_cached_answers', (now,)),
+        ('get_oauth_token', ('mpesa',)),
+        ('store_oauth_token', ('mpesa', 'plan-check', now)),
+        ('get_session', ('plan-check',)),
+        ('store_session', ('plan-check', '{}', now)),
+        ('delete_session', ('plan-check',)),
+        ('purge_expired_sessions', (now,)),
+        ('get_entitlement_changes', (0,)),
+        ('get_last_entitlement_change', ()),
+        ('purge_entitlement_changes', (now,)),
+        ('get_inline_responses', ()),
+        ('compress_responses', ([(1, 'answer')],)),
+        ('get_archivable_responses', (now,)),
+        ('mark_responses_archived', ([(1, '0' * 64)],)),
+        ('get_token_spend', (now,)),
+        ('get_rollups', (now.date(),)),
+        ('get_rollup_totals', (list(PRICING),)),
+        ('get_referenced_images', ()),
+    ]
+    
+    check = QueryPlanCheck(db.pool, db.dialect)
+    unchecked = check.run(db, calls)
+    
+    failed = False
+    for method, statement, scans in check.plans:
+        if scans:
+            failed = True
+            click.echo(f"SEQ SCAN on {', '.join(scans)} in Database.{method}: {statement}")
+        elif verbose:
+            click.echo(f"ok  Database.{method}: {statement}")
+    for method, statement, error in check.errors:
+        failed = True
+        click.echo(f"PLAN FAILED in Database.{method}: {error}: {statement}")
+    for method, error in check.incomplete:
+        failed = True
+        click.echo(f"INCOMPLETE Database.{method} stopped before its last statement: {error}")
+    for method in unchecked:
+        failed = True
+        click.echo(f"UNCHECKED Database.{method}: add it to check-query-plans")
+    
+    click.echo(f"Planned {len(check.plans)} statements from {len(calls)} methods ({db.dialect})")
+    if failed:
+        raise SystemExit(1)
+
 if __name__ == '__main__':
     # Create uploads directory if it doesn't exist
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
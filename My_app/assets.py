@@ -0,0 +1,106 @@
+"""Fingerprinted, minified and precompressed static assets.
+
+build() copies each stylesheet and script under static/ to static/dist/
+with a content hash in its name (css/styles.css -> css/styles.1a2b3c4d5e.css),
+next to .gz and, when the brotli package is installed, .br variants, and
+writes manifest.json mapping source names to built ones. Built names change
+whenever the content does, so they can be cached forever.
+
+Run ``python assets.py`` as a build step, or let the app build on start.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import secrets
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    # Not around ':' - "a :hover" and "a:hover" are different selectors
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    """Drop indentation, blank lines and whole-line // comments.
+
+    Deliberately no more than that: anything smarter needs a real parser to
+    stay clear of strings and regex literals.
+    """
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+def write_atomic(path, data):
+    """Write then rename, so workers building at once never serve a partial file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def sources(static_folder):
+    """Yield static-relative paths of every asset build() handles"""
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != os.path.join(static_folder, DIST_DIR))
+        for name in sorted(files):
+            if os.path.splitext(name)[1] in MINIFIERS:
+                yield os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+
+
+def build(static_folder):
+    """Build every asset not already built from its current content; returns the manifest"""
+    dist = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+    for source in sources(static_folder):
+        base, ext = os.path.splitext(source)
+        with open(os.path.join(static_folder, source), encoding='utf-8') as f:
+            data = MINIFIERS[ext](f.read()).encode('utf-8')
+        built = f"{base}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+        manifest[source] = built
+
+        path = os.path.join(dist, built)
+        if not os.path.exists(path):
+            write_atomic(path + '.gz', gzip.compress(data, 9, mtime=0))
+            if brotli:
+                write_atomic(path + '.br', brotli.compress(data, quality=11))
+            # Written last: its presence means the variants are there too
+            write_atomic(path, data)
+
+    write_atomic(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def load_manifest(static_folder):
+    """The manifest from the last build, or {} if there hasn't been one"""
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--static-folder', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    args = parser.parse_args()
+    for source, built in build(args.static_folder).items():
+        print(f"{source} -> {DIST_DIR}/{built}")
+    if brotli is None:
+        print("brotli is not installed; built gzip variants only")
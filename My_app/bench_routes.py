@@ -0,0 +1,354 @@
+"""Load-test the main routes under gunicorn against stubbed upstreams.
+
+Starts stub_servers.py in place of DeepSeek and Safaricom, seeds a
+database with bench users, questions, payments and subscriptions, runs
+the real app under gunicorn, then drives /login, /dashboard, /ask and
+/callback from concurrent virtual users for a fixed duration and reports
+throughput, latency percentiles, error rates and requests in flight on
+the server per route (by Little's law: total server time, from each
+response's Server-Timing header, over the run length; time queued for a
+free worker thread isn't counted). Throughput counts requests finished
+within the run, and in-flight only the part of each request inside it,
+not the drain after it.
+
+Uses a fresh SQLite file unless DATABASE_URL points at PostgreSQL (bench
+rows are only seeded once per database). Run from this directory:
+
+    python bench_routes.py --duration 30 --concurrency 20 --workers 2 --threads 8
+    python bench_routes.py --stub-latency 1.5 --stub-fail-rate 0.05 --output before.json
+
+Concurrent /ask requests one worker can hold while M-Pesa answers slowly,
+threads against greenlets:
+
+    python bench_routes.py --workers 1 --threads 8 --payers-only --mix ask=1 --concurrency 300 --stub-latency 2
+    python bench_routes.py --workers 1 --worker-class gevent --payers-only --mix ask=1 --concurrency 300 --stub-latency 2
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench-password'
+ROUTES = ('login', 'dashboard', 'ask', 'callback')
+
+
+def app_environment(args):
+    env = dict(os.environ)
+    stub = f'http://127.0.0.1:{args.stub_port}'
+    env.update({
+        'FLASK_SECRET_KEY': env.get('FLASK_SECRET_KEY', 'bench'),
+        'DEEPSEEK_API_URL': f'{stub}/v1/chat/completions',
+        'DEEPSEEK_API_KEY': 'bench',
+        'MPESA_API_URL': stub,
+        'MPESA_CONSUMER_KEY': 'bench',
+        'MPESA_CONSUMER_SECRET': 'bench',
+        'MPESA_BUSINESS_SHORTCODE': '174379',
+        'MPESA_PASSKEY': 'bench',
+        'MPESA_CALLBACK_URL': f'http://127.0.0.1:{args.port}',
+        'MPESA_CALLBACK_TOKEN': 'bench',
+        # Every virtual user logs in from 127.0.0.1, so lift the login throttles
+        'LOGIN_USERNAME_LIMIT': '1000000',
+        'LOGIN_IP_LIMIT': '1000000',
+    })
+    if not env.get('DATABASE_URL'):
+        env['SQLITE_PATH'] = args.sqlite_path
+    return env
+
+
+def seed(args):
+    """Insert bench users with question, payment and subscription history"""
+    os.environ.update(app_environment(args))
+    sys.path.insert(0, HERE)
+    from app import db, password_hasher
+
+    if db.get_credentials('bench0'):
+        print("Bench data already present, skipping seed")
+        return
+
+    started = time.perf_counter()
+    password_hash = password_hasher.hash(PASSWORD)
+    now = datetime.now()
+    with db.pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+        INSERT INTO users (username, password_hash, email, phone)
+        VALUES (%s, %s, %s, %s)
+        ''', [(f'bench{i}', password_hash, f'bench{i}@example.com', f'2547{i:08d}')
+              for i in range(args.users)])
+        cursor.execute("SELECT id, username FROM users WHERE username LIKE 'bench%%'")
+        user_ids = [user_id for user_id, _ in sorted(cursor.fetchall(), key=lambda row: int(row[1][5:]))]
+
+        answer = "Step by step: " + "start from what the question gives you and work forward. " * 40
+        questions, payments, subscriptions = [], [], []
+        for n, user_id in enumerate(user_ids):
+            for k in range(args.questions_per_user):
+                asked = now - timedelta(minutes=37 * k + n)
+                questions.append((user_id, 'text', f'Bench question {k}: what is {k} + {n}?',
+                                  answer, asked, 10))
+            for k in range(args.payments_per_user):
+                payments.append((user_id, 10, f'2547{n:08d}', f'BENCH{n}X{k}', 'completed',
+                                 now - timedelta(hours=5 * k + n), None))
+            # Pending STK pushes for the callback route to resolve
+            for k in range(args.pending_per_user):
+                payments.append((user_id, 10, f'2547{n:08d}', None, 'pending',
+                                 now - timedelta(minutes=k), f'ws_CO_bench_{n}_{k}'))
+            if n % 2 == 0:
+                subscriptions.append((user_id, 'monthly', now - timedelta(days=1), now + timedelta(days=29)))
+
+        cursor.executemany('''
+        INSERT INTO questions (user_id, question_type, content, response, timestamp, cost)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ''', questions)
+        cursor.executemany('''
+        INSERT INTO payments (user_id, amount, phone_number, mpesa_receipt, status, transaction_date, checkout_request_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', payments)
+        cursor.executemany('''
+        INSERT INTO subscriptions (user_id, plan_type, start_date, end_date)
+        VALUES (%s, %s, %s, %s)
+        ''', subscriptions)
+        conn.commit()
+        cursor.close()
+
+    print(f"Seeded {len(user_ids)} users, {len(questions)} questions, {len(payments)} payments "
+          f"in {time.perf_counter() - started:.1f}s")
+
+
+def wait_until_up(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+class VirtualUser(threading.Thread):
+    """Logs in as one bench user, then hits weighted random routes until the deadline"""
+
+    def __init__(self, number, args, base_url, deadline, results, lock, http=None):
+        super().__init__(daemon=True)
+        self.number = number
+        self.args = args
+        self.base_url = base_url
+        self.deadline = deadline
+        self.results = results
+        self.lock = lock
+        # Even-numbered bench users subscribe; odd ones pay per question, so /ask waits on the STK push
+        self.username = f'bench{(2 * number + 1) % args.users}' if args.payers_only else f'bench{number % args.users}'
+        self.http = http or requests.Session()
+        self.pending = [f'ws_CO_bench_{number % args.users}_{k}' for k in range(args.pending_per_user)]
+        self.routes, self.weights = zip(*args.mix.items())
+
+    def login(self):
+        return self.http.post(f'{self.base_url}/login', allow_redirects=False,
+                              data={'username': self.username, 'password': PASSWORD}), (302,)
+
+    def dashboard(self):
+        return self.http.get(f'{self.base_url}/dashboard', allow_redirects=False), (200,)
+
+    def ask(self):
+        if random.random() < self.args.repeat_rate:
+            question = "What is photosynthesis?"  # Answer-cache hits after the first
+        else:
+            question = f"What is {random.randint(1, 10 ** 6)} times {random.randint(1, 10 ** 6)}?"
+        response = self.http.post(f'{self.base_url}/ask', allow_redirects=False,
+                                  headers={'Accept': 'application/json'}, data={'question': question})
+        # 200 for cached answers; failures re-render the HTML form even for JSON clients
+        json_reply = response.headers.get('Content-Type', '').startswith('application/json')
+        return response, (200, 202) if json_reply else ()
+
+    def callback(self):
+        # Pending payments resolve once; later callbacks exercise the idempotent path
+        checkout_request_id = self.pending.pop() if self.pending else f'ws_CO_unknown_{self.number}'
+        payload = {"Body": {"stkCallback": {
+            "MerchantRequestID": "bench",
+            "CheckoutRequestID": checkout_request_id,
+            "ResultCode": 0,
+            "ResultDesc": "The service request is processed successfully.",
+            "CallbackMetadata": {"Item": [
+                {"Name": "Amount", "Value": 10},
+                {"Name": "MpesaReceiptNumber", "Value": f"BENCH{random.randint(0, 10 ** 9)}"},
+            ]}
+        }}}
+        return self.http.post(f'{self.base_url}/callback/bench', json=payload), (200,)
+
+    def record(self, route, seconds, ok, server_seconds):
+        with self.lock:
+            self.results[route].append((seconds, ok, server_seconds, time.monotonic()))
+
+    def run(self):
+        # A burst of logins can overrun the password-hash queue; retry the refused ones
+        while not self.http.cookies and time.monotonic() < self.deadline:
+            try:
+                if self.login()[0].status_code == 302:
+                    break
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(random.uniform(0.1, 0.5))
+        while time.monotonic() < self.deadline:
+            route = random.choices(self.routes, self.weights)[0]
+            start = time.perf_counter()
+            server_seconds = 0.0
+            try:
+                response, expected = getattr(self, route)()
+                ok = response.status_code in expected
+                server_seconds = server_time(response)
+            except requests.exceptions.RequestException:
+                ok = False
+            self.record(route, time.perf_counter() - start, ok, server_seconds)
+
+
+def server_time(response):
+    """Seconds the app spent on a request, from the total in its Server-Timing header"""
+    for timing in response.headers.get('Server-Timing', '').split(','):
+        name, _, duration = timing.strip().partition(';dur=')
+        if name == 'total':
+            return float(duration) / 1000
+    return 0.0
+
+
+def overlap(start, end, window_start, window_end):
+    return max(min(end, window_end) - max(start, window_start), 0.0)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def report(results, started, duration):
+    rows = {}
+    print(f"\n{'route':<12}{'requests':>10}{'rps':>9}{'p50 ms':>9}{'p90 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>9}{'errors':>9}{'in flight':>11}")
+    for route, samples in results.items():
+        if not samples:
+            continue
+        latencies = sorted(seconds * 1000 for seconds, _, _, _ in samples)
+        errors = sum(1 for _, ok, _, _ in samples if not ok)
+        within = [sample for sample in samples if sample[3] <= started + duration]
+        rows[route] = {
+            'requests': len(samples),
+            'rps': round(len(within) / duration, 2),
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p90_ms': round(percentile(latencies, 0.9), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'max_ms': round(latencies[-1], 2),
+            'error_rate': round(errors / len(samples), 4),
+            'in_flight': round(sum(overlap(finished - server_seconds, finished, started, started + duration)
+                                   for _, _, server_seconds, finished in samples) / duration, 1),
+        }
+        row = rows[route]
+        print(f"{route:<12}{row['requests']:>10}{row['rps']:>9.1f}{row['p50_ms']:>9.1f}{row['p90_ms']:>9.1f}"
+              f"{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}{row['error_rate']:>9.2%}{row['in_flight']:>11.1f}")
+    return rows
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        route, weight = part.split('=')
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route {route}; choose from {', '.join(ROUTES)}")
+        mix[route] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load after warm-up')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--concurrency', type=int, default=20, help='Virtual users')
+    parser.add_argument('--mix', type=parse_mix, default='login=1,dashboard=6,ask=2,callback=1',
+                        help='Route weights, e.g. dashboard=6,ask=2')
+    parser.add_argument('--repeat-rate', type=float, default=0.2, help='Share of /ask hitting a repeated question')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--worker-class', default='gthread', help='gunicorn worker class, e.g. gevent')
+    parser.add_argument('--worker-connections', type=int, default=1000, help='Concurrent requests per gevent worker')
+    parser.add_argument('--payers-only', action='store_true',
+                        help='Only drive pay-per-use users, whose /ask holds the request through the STK push')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--stub-port', type=int, default=8091)
+    parser.add_argument('--stub-latency', type=float, default=0.5, help='Seconds each upstream call takes')
+    parser.add_argument('--stub-token-delay', type=float, default=0.0)
+    parser.add_argument('--stub-fail-rate', type=float, default=0.0, help='Share of upstream calls answered 503')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--questions-per-user', type=int, default=100)
+    parser.add_argument('--payments-per-user', type=int, default=20)
+    parser.add_argument('--pending-per-user', type=int, default=5)
+    parser.add_argument('--sqlite-path', default=os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db'))
+    parser.add_argument('--output', help='Also write the report as JSON, for comparing runs')
+    args = parser.parse_args()
+
+    seed(args)
+
+    env = app_environment(args)
+    processes = []
+    try:
+        stubs = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'stub_servers.py'), '--port', str(args.stub_port),
+             '--latency', str(args.stub_latency), '--token-delay', str(args.stub_token_delay),
+             '--fail-rate', str(args.stub_fail_rate)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(stubs)
+        server = subprocess.Popen(
+            ['gunicorn', 'app:app', '--bind', f'127.0.0.1:{args.port}', '--workers', str(args.workers),
+             '--worker-class', args.worker_class, '--threads', str(args.threads),
+             '--worker-connections', str(args.worker_connections), '--log-level', 'warning'],
+            cwd=HERE, env=env)
+        processes.append(server)
+        wait_until_up(f'http://127.0.0.1:{args.stub_port}/', stubs)
+        wait_until_up(f'http://127.0.0.1:{args.port}/health', server)
+
+        base_url = f'http://127.0.0.1:{args.port}'
+        warmup_results = {route: [] for route in ROUTES}
+        results = {route: [] for route in ROUTES}
+        lock = threading.Lock()
+
+        warmup = [VirtualUser(n, args, base_url, time.monotonic() + args.warmup, warmup_results, lock)
+                  for n in range(args.concurrency)]
+        for user in warmup:
+            user.start()
+        for user in warmup:
+            user.join()
+
+        per_worker = args.worker_connections if args.worker_class == 'gevent' else args.threads
+        print(f"Driving {args.concurrency} virtual users for {args.duration:.0f}s "
+              f"({args.workers} {args.worker_class} workers x {per_worker} concurrent requests)")
+        started = time.monotonic()
+        # Carry on in the warm-up sessions so the run doesn't open with a burst of logins
+        users = [VirtualUser(n, args, base_url, started + args.duration, results, lock, http=warmup[n].http)
+                 for n in range(args.concurrency)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        rows = report(results, started, args.duration)
+        if 'ask' in rows:
+            print(f"\n/ask in flight per worker: {rows['ask']['in_flight'] / args.workers:.1f}")
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({'config': {k: v for k, v in vars(args).items() if k != 'output'},
+                           'routes': rows}, f, indent=2)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
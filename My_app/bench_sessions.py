@@ -0,0 +1,68 @@
+"""Measure per-request session overhead for each session backend.
+
+Replays requests carrying an established session cookie through the
+backend's open_session/save_session, both for requests that only read the
+session (the common case) and for requests that change it. Run from this
+directory with the app's usual environment (SQLite unless DATABASE_URL is set):
+
+    FLASK_SECRET_KEY=dev python bench_sessions.py --requests 2000
+"""
+import argparse
+import statistics
+import time
+
+from flask import request
+
+from app import app, create_session_interface
+
+
+def replay(interface, cookie, requests_count, modify):
+    timings = []
+    for i in range(requests_count):
+        with app.test_request_context('/', headers={'Cookie': cookie}):
+            start = time.perf_counter()
+            session = interface.open_session(app, request)
+            session.get('user_id')
+            if modify:
+                session['last_seen'] = i
+            interface.save_session(app, session, app.response_class())
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench(backend, requests_count):
+    interface = create_session_interface(backend)
+
+    # Log in once to get a cookie, as /login would
+    with app.test_request_context('/'):
+        session = interface.open_session(app, request)
+        session['user_id'] = 1
+        response = app.response_class()
+        interface.save_session(app, session, response)
+        cookie = response.headers['Set-Cookie'].split(';', 1)[0]
+
+    results = {}
+    for label, modify in (('read', False), ('write', True)):
+        timings = sorted(replay(interface, cookie, requests_count, modify))
+        results[label] = (
+            statistics.mean(timings) * 1e6,
+            timings[len(timings) // 2] * 1e6,
+            timings[int(len(timings) * 0.99)] * 1e6,
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--backends', default='cookie,database,filesystem')
+    args = parser.parse_args()
+
+    print(f"{'backend':<12}{'request':<8}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}")
+    for backend in args.backends.split(','):
+        for label, (mean, p50, p99) in bench(backend, args.requests).items():
+            print(f"{backend:<12}{label:<8}{mean:>10.1f}{p50:>10.1f}{p99:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""gunicorn settings, picked up automatically from this directory.
+
+The Procfile stays `gunicorn app:app`; the worker model comes from the
+environment. The default is gunicorn's own (one sync thread per worker).
+GUNICORN_WORKER_CLASS=gevent serves every request on a greenlet, so a worker
+holds hundreds of requests waiting on M-Pesa, DeepSeek, PostgreSQL or a
+long poll instead of one per thread; app.py makes psycopg2 cooperative and
+moves password hashing and image work onto native threads when it sees gevent.
+Command-line flags still win over these. A worker that serves one request at
+a time (the default) answers status polls at once instead of holding them.
+"""
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')  # sync, gthread or gevent
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))  # Concurrent requests per gevent worker
+threads = int(os.getenv('GUNICORN_THREADS', 1))  # Request threads per sync/gthread worker
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))  # Seconds a worker may go silent before it is restarted
+
+# The app must be imported after gevent patches the worker, never in the master
+preload_app = False
+
+
+def post_fork(server, worker):
+    # Runs before the worker imports the app: tell it the thread count, flags included
+    os.environ['GUNICORN_THREADS'] = str(worker.cfg.threads)
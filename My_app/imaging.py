@@ -0,0 +1,45 @@
+"""CPU-bound image preprocessing for uploaded homework photos.
+
+Kept free of app imports so process-pool workers start cheaply and never
+open database connections of their own.
+"""
+import base64
+import io
+import time
+
+from PIL import Image
+
+MAX_DIMENSION = 1024
+JPEG_QUALITY = 85
+
+def process_image(image_bytes, max_dimension=MAX_DIMENSION, quality=JPEG_QUALITY):
+    """Downscale and re-encode an upload as a base64 JPEG.
+
+    Returns ``(image_base64, timings)`` where timings holds the seconds spent
+    in the decode, resize and encode stages.
+    """
+    timings = {}
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Let libjpeg decode large JPEGs at 1/2, 1/4 or 1/8 scale instead of full size
+        if img.format == 'JPEG':
+            img.draft('RGB', (max_dimension, max_dimension))
+        img.load()
+        decoded = time.perf_counter()
+        timings['decode'] = decoded - started
+        
+        # Convert to RGB if needed (for PNG with transparency)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        
+        # Resize if too large
+        if max(img.size) > max_dimension:
+            img.thumbnail((max_dimension, max_dimension))
+        resized = time.perf_counter()
+        timings['resize'] = resized - decoded
+        
+        buffered = io.BytesIO()
+        img.save(buffered, format='JPEG', quality=quality)
+        image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+        timings['encode'] = time.perf_counter() - resized
+    return image_base64, timings
@@ -0,0 +1,141 @@
+"""Non-blocking logging: request threads enqueue records, one thread writes them.
+
+configure_logging() installs a QueueHandler on the root logger and starts
+a QueueListener that formats and writes on its own thread, so file I/O,
+rotation and message formatting never run on a request thread. Records
+can be written as JSON lines, the file rotates by size or time, and noisy
+loggers can be sampled.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else was passed through extra=
+STANDARD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra= fields as top-level keys"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a share of records below WARNING from the configured loggers.
+
+    ``rates`` maps logger names to the fraction kept; a rate for ``mpesa``
+    also covers ``mpesa.callback``. Warnings and errors always pass.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def rate_for(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self.rate_for(record.name)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records untouched and drop them if the writer falls behind.
+
+    The stock QueueHandler formats the message in the calling thread so the
+    record can be pickled; the listener here lives in the same process, so
+    formatting is left to the writer thread.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+def parse_sample_rates(spec):
+    """'mpesa.callback=0.1,werkzeug=0.01' -> {'mpesa.callback': 0.1, 'werkzeug': 0.01}"""
+    rates = {}
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        name, rate = part.split('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def process_log_file(log_file, pid=None):
+    """'logs/app.log' -> 'logs/app.<pid>.log', so each process rotates a file of its own"""
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.{pid or os.getpid()}{ext}"
+
+
+def configure_logging(level='INFO', json_lines=True, log_file='app.log', max_bytes=10 * 1024 * 1024,
+                      backup_count=5, rotate_when=None, queue_size=10000, sample_rates=None, per_process=False):
+    """Route all logging through a queue to a single writer thread; returns the queue handler.
+
+    Rotating handlers in several processes must not share one file: each
+    would rename it under the others. With per_process the file name gets
+    the process ID, as for gunicorn workers. Set log_file to '' to log to
+    stdout only and let the platform collect it.
+    """
+    formatter = JsonFormatter() if json_lines else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        if per_process:
+            log_file = process_log_file(log_file)
+        if rotate_when:
+            handlers.append(logging.handlers.TimedRotatingFileHandler(log_file, when=rotate_when, backupCount=backup_count))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Flush what's queued on a clean exit
+    atexit.register(listener.stop)
+    return queue_handler
@@ -0,0 +1,381 @@
+"""Versioned schema migrations for PostgreSQL and SQLite.
+
+Migrations are applied in order, each in its own transaction, and recorded
+in ``schema_migrations`` so every one runs exactly once per database.
+Workers starting together serialize on a lock (an advisory lock on
+PostgreSQL, ``BEGIN IMMEDIATE`` on SQLite) and re-check before applying.
+
+To change the schema, append a migration; never edit one that has shipped.
+Steps are SQL strings, with ``{serial}`` and ``{blob}`` standing in for the
+dialect's auto-increment primary key and binary type, or callables taking
+``(cursor, dialect)``.
+"""
+import logging
+from datetime import datetime, timedelta
+
+DIALECT_TYPES = {
+    'postgresql': {'serial': 'SERIAL PRIMARY KEY', 'blob': 'BYTEA'},
+    'sqlite': {'serial': 'INTEGER PRIMARY KEY', 'blob': 'BLOB'},
+}
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every worker
+ADVISORY_LOCK_KEY = 7241901
+
+
+def add_column(table, column, definition):
+    """Step adding a column unless an earlier, unversioned upgrade already did"""
+    def step(cursor, dialect):
+        if dialect == 'postgresql':
+            cursor.execute('''
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = %s AND column_name = %s
+            ''', (table, column))
+            exists = cursor.fetchone() is not None
+        else:
+            cursor.execute(f'PRAGMA table_info({table})')
+            exists = any(row[1] == column for row in cursor.fetchall())
+        if not exists:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return step
+
+
+def questions_to_app_clock(cursor, dialect):
+    """Step moving question timestamps from the database clock to the app's.
+
+    questions.timestamp used to come from the column default, which is UTC
+    on SQLite and the session time zone on PostgreSQL, while everything else
+    is stamped with the app's local datetime.now().
+    """
+    if dialect == 'sqlite':
+        cursor.execute("UPDATE questions SET timestamp = datetime(timestamp, 'localtime')")
+        return
+    cursor.execute('SELECT LOCALTIMESTAMP')
+    offset = datetime.now() - cursor.fetchone()[0]
+    # Time zones differ by whole quarter hours; the rest is the round trip
+    offset = timedelta(minutes=15 * round(offset.total_seconds() / 900))
+    if offset:
+        cursor.execute('UPDATE questions SET timestamp = timestamp + %s', (offset,))
+
+
+# Tables use IF NOT EXISTS so databases created before versioning adopt cleanly
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id {serial},
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            email TEXT UNIQUE,
+            phone TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            id {serial},
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            amount REAL NOT NULL,
+            mpesa_receipt TEXT,
+            phone_number TEXT NOT NULL,
+            transaction_date TIMESTAMP,
+            status TEXT DEFAULT 'pending',
+            CHECK (status IN ('pending', 'completed', 'failed'))
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id {serial},
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            plan_type TEXT NOT NULL,
+            start_date TIMESTAMP NOT NULL,
+            end_date TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE,
+            payment_id INTEGER REFERENCES payments(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS questions (
+            id {serial},
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            question_type TEXT NOT NULL,
+            content TEXT,
+            image_path TEXT,
+            response TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            cost REAL NOT NULL,
+            payment_id INTEGER REFERENCES payments(id)
+        )
+        ''',
+        # Subscription checks
+        '''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active
+        ON subscriptions (user_id, end_date) WHERE is_active = TRUE
+        ''',
+        # Payment lookups
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_user_status
+        ON payments (user_id, status)
+        ''',
+    ]),
+    (2, 'background answer jobs', [
+        '''
+        CREATE TABLE IF NOT EXISTS answer_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            status TEXT NOT NULL DEFAULT 'queued',
+            question_id INTEGER REFERENCES questions(id),
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            CHECK (status IN ('queued', 'running', 'completed', 'failed'))
+        )
+        ''',
+    ]),
+    (3, 'M-Pesa callback tracking', [
+        add_column('payments', 'purpose', "TEXT DEFAULT 'question'"),
+        add_column('payments', 'plan_type', 'TEXT'),
+        add_column('payments', 'checkout_request_id', 'TEXT'),
+        add_column('payments', 'merchant_request_id', 'TEXT'),
+        add_column('payments', 'result_desc', 'TEXT'),
+        # Resolving M-Pesa callbacks
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_checkout
+        ON payments (checkout_request_id)
+        ''',
+        # Questions waiting for their payment to complete
+        '''
+        CREATE TABLE IF NOT EXISTS pending_questions (
+            payment_id INTEGER PRIMARY KEY REFERENCES payments(id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            question_type TEXT NOT NULL,
+            content TEXT,
+            image_path TEXT,
+            job_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (4, 'shared OAuth tokens and answer cache', [
+        '''
+        CREATE TABLE IF NOT EXISTS oauth_tokens (
+            name TEXT PRIMARY KEY,
+            access_token TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            cache_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        )
+        ''',
+    ]),
+    (5, 'dashboard data version', [
+        add_column('users', 'data_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ]),
+    (6, 'history and maintenance indexes', [
+        # Recent questions and payments, newest first
+        '''
+        CREATE INDEX IF NOT EXISTS idx_questions_user_timestamp
+        ON questions (user_id, timestamp DESC)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_user_transaction_date
+        ON payments (user_id, transaction_date DESC)
+        ''',
+        # Answer cache expiry
+        '''
+        CREATE INDEX IF NOT EXISTS idx_answer_cache_created
+        ON answer_cache (created_at)
+        ''',
+        # Upload garbage collection
+        '''
+        CREATE INDEX IF NOT EXISTS idx_questions_image_path
+        ON questions (image_path) WHERE image_path IS NOT NULL
+        ''',
+    ]),
+    (7, 'keyset pagination indexes', [
+        # (timestamp, id) keys history pages; these supersede the indexes from 6
+        '''
+        CREATE INDEX IF NOT EXISTS idx_questions_user_timestamp_id
+        ON questions (user_id, timestamp DESC, id DESC)
+        ''',
+        'DROP INDEX IF EXISTS idx_questions_user_timestamp',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_user_transaction_date_id
+        ON payments (user_id, transaction_date DESC, id DESC)
+        ''',
+        'DROP INDEX IF EXISTS idx_payments_user_transaction_date',
+    ]),
+    (8, 'database sessions', [
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_key TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        )
+        ''',
+        # Batched expiry cleanup
+        '''
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires
+        ON sessions (expires_at)
+        ''',
+    ]),
+    (9, 'AI token usage', [
+        add_column('questions', 'prompt_tokens', 'INTEGER'),
+        add_column('questions', 'completion_tokens', 'INTEGER'),
+        # Token spend reports over a time window
+        '''
+        CREATE INDEX IF NOT EXISTS idx_questions_timestamp
+        ON questions (timestamp)
+        ''',
+    ]),
+    (10, 'entitlement change log', [
+        # Workers poll this for users whose cached subscription is stale
+        '''
+        CREATE TABLE IF NOT EXISTS entitlement_changes (
+            id {serial},
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            changed_at TIMESTAMP NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_entitlement_changes_changed
+        ON entitlement_changes (changed_at)
+        ''',
+    ]),
+    (11, 'compressed answer storage', [
+        # zlib-compressed answers, kept out of the questions table
+        '''
+        CREATE TABLE IF NOT EXISTS question_responses (
+            question_id INTEGER PRIMARY KEY REFERENCES questions(id),
+            body {blob} NOT NULL
+        )
+        ''',
+        add_column('questions', 'response_preview', 'TEXT'),
+        # NULL: still inline in questions.response; 'db': in question_responses;
+        # 'archive:<sha256>': a compressed file in the cold archive
+        add_column('questions', 'response_ref', 'TEXT'),
+        # Finding answers still stored inline
+        '''
+        CREATE INDEX IF NOT EXISTS idx_questions_inline_response
+        ON questions (id) WHERE response_ref IS NULL AND response IS NOT NULL
+        ''',
+    ]),
+    (12, 'usage rollups', [
+        # Kept up to date by the writes themselves; rebuilt by backfill-rollups
+        '''
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            day DATE NOT NULL,
+            plan TEXT NOT NULL,
+            payments_started INTEGER NOT NULL DEFAULT 0,
+            payments_completed INTEGER NOT NULL DEFAULT 0,
+            payments_failed INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            text_questions INTEGER NOT NULL DEFAULT 0,
+            image_questions INTEGER NOT NULL DEFAULT 0,
+            subscriptions_started INTEGER NOT NULL DEFAULT 0,
+            active_subscribers INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS rollup_totals (
+            plan TEXT PRIMARY KEY,
+            payments_started INTEGER NOT NULL DEFAULT 0,
+            payments_completed INTEGER NOT NULL DEFAULT 0,
+            payments_failed INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            text_questions INTEGER NOT NULL DEFAULT 0,
+            image_questions INTEGER NOT NULL DEFAULT 0,
+            subscriptions_started INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+    ]),
+    (13, 'payment fulfilment', [
+        # Set once a completed payment's subscription or answer job exists
+        add_column('payments', 'fulfilled_at', 'TIMESTAMP'),
+        '''
+        UPDATE payments SET fulfilled_at = transaction_date
+        WHERE status = 'completed' AND fulfilled_at IS NULL
+        ''',
+        # Completed payments whose follow-up still has to run
+        '''
+        CREATE INDEX IF NOT EXISTS idx_payments_unfulfilled
+        ON payments (transaction_date) WHERE status = 'completed' AND fulfilled_at IS NULL
+        ''',
+    ]),
+    (14, 'pending upload references', [
+        # Upload garbage collection also keeps images of questions awaiting payment
+        '''
+        CREATE INDEX IF NOT EXISTS idx_pending_questions_image_path
+        ON pending_questions (image_path) WHERE image_path IS NOT NULL
+        ''',
+    ]),
+    (15, 'question timestamps on the app clock', [
+        questions_to_app_clock,
+    ]),
+]
+
+
+def applied_versions(cursor):
+    cursor.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def lock(cursor, dialect):
+    """Start a transaction that excludes other workers' migration runs"""
+    if dialect == 'postgresql':
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (ADVISORY_LOCK_KEY,))
+    else:
+        cursor.execute('BEGIN IMMEDIATE')
+
+
+def migrate(pool, dialect):
+    """Apply pending migrations and return the resulting schema version.
+
+    Raises on failure: the failed migration is rolled back and the app
+    should not start on a half-migrated schema.
+    """
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''')
+            conn.commit()
+
+            pending = [m for m in MIGRATIONS if m[0] not in applied_versions(cursor)]
+            conn.rollback()
+            for version, description, steps in pending:
+                lock(cursor, dialect)
+                # Another worker may have applied it while we waited
+                if version in applied_versions(cursor):
+                    conn.rollback()
+                    continue
+
+                for step in steps:
+                    if callable(step):
+                        step(cursor, dialect)
+                    else:
+                        cursor.execute(step.format(**DIALECT_TYPES[dialect]))
+                cursor.execute('''
+                INSERT INTO schema_migrations (version, description)
+                VALUES (%s, %s)
+                ''', (version, description))
+                conn.commit()
+                logging.info(f"Applied migration {version}: {description}")
+
+            return max(m[0] for m in MIGRATIONS)
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Migration failed: {e}")
+            raise
+        finally:
+            cursor.close()
@@ -75,14 +75,21 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
-    // Payment status polling (for demo purposes)
+    // Payment status polling, resolved by the M-Pesa callback
     const paymentStatusElement = document.getElementById('paymentStatus');
     if (paymentStatusElement) {
-        // This would normally be handled by the M-Pesa callback
-        // Here we just simulate it for the demo
-        setTimeout(() => {
-            paymentStatusElement.innerHTML = '<span class="badge bg-success">Completed</span>';
-        }, 3000);
+        waitForPayment(paymentStatusElement, paymentStatusElement.dataset.statusUrl,
+                       Number(paymentStatusElement.dataset.wait || 0));
+    }
+
+    // Stream a queued AI answer as it is generated, or poll for it
+    const answerStatusElement = document.getElementById('answerStatus');
+    if (answerStatusElement) {
+        if (window.EventSource && answerStatusElement.dataset.streamUrl) {
+            streamAnswer(answerStatusElement);
+        } else {
+            pollAnswer(answerStatusElement, answerStatusElement.dataset.statusUrl, 1000);
+        }
     }
 
     // Logout confirmation
@@ -152,6 +159,99 @@ function handleApiError(error) {
     alert('An error occurred. Please try again later.');
 }
 
+// Poll a payment until the callback resolves it, then move on to the answer.
+// With wait > 0 the server holds each request open; otherwise back off to 5 seconds.
+async function waitForPayment(element, statusUrl, wait) {
+    let delay = 1000;
+    while (true) {
+        try {
+            const response = await fetch(statusUrl + '?wait=' + wait, {
+                headers: {
+                    'Accept': 'application/json'
+                }
+            });
+            const result = await response.json();
+            
+            if (result.status === 'failed' || !response.ok) {
+                element.innerHTML = '<span class="badge bg-danger">Payment failed</span>';
+                return;
+            }
+            if (result.answer_url) {
+                window.location = result.answer_url;
+                return;
+            }
+            if (result.status === 'completed' && result.purpose !== 'question') {
+                element.innerHTML = '<span class="badge bg-success">Completed</span>';
+                return;
+            }
+            if (!wait) {
+                await new Promise(resolve => setTimeout(resolve, delay));
+                delay = Math.min(delay * 1.5, 5000);
+            }
+        } catch (error) {
+            console.error('API Error:', error);
+            await new Promise(resolve => setTimeout(resolve, 5000));
+        }
+    }
+}
+
+// Show answer tokens over server-sent events; fall back to polling if the stream can't finish
+function streamAnswer(element) {
+    const source = new EventSource(element.dataset.streamUrl);
+    let started = false;
+    
+    const fallBack = () => {
+        source.close();
+        pollAnswer(element, element.dataset.statusUrl, 1000);
+    };
+    
+    source.addEventListener('token', (e) => {
+        if (!started) {
+            element.textContent = '';
+            started = true;
+        }
+        element.textContent += JSON.parse(e.data).text;
+    });
+    source.addEventListener('completed', (e) => {
+        source.close();
+        element.textContent = JSON.parse(e.data).response;
+    });
+    source.addEventListener('failed', (e) => {
+        source.close();
+        element.classList.add('text-danger');
+        element.textContent = JSON.parse(e.data).error || 'Failed to process question. Please try again.';
+    });
+    source.addEventListener('pending', fallBack);
+    source.onerror = fallBack;
+}
+
+// Poll a queued question until its answer is ready, backing off to 5 seconds
+function pollAnswer(element, statusUrl, delay) {
+    setTimeout(async () => {
+        try {
+            const response = await fetch(statusUrl, {
+                headers: {
+                    'Accept': 'application/json'
+                }
+            });
+            const result = await response.json();
+            
+            if (result.status === 'completed') {
+                element.textContent = result.response;
+                return;
+            }
+            if (result.status === 'failed' || !response.ok) {
+                element.classList.add('text-danger');
+                element.textContent = result.error || 'Failed to process question. Please try again.';
+                return;
+            }
+        } catch (error) {
+            console.error('API Error:', error);
+        }
+        pollAnswer(element, statusUrl, Math.min(delay * 1.5, 5000));
+    }, delay);
+}
+
 // Image upload helper
 function setupImageUpload(inputId, previewId) {
     const input = document.getElementById(inputId);
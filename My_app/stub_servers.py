@@ -0,0 +1,143 @@
+"""Local stand-ins for the upstream APIs so the app runs without real credentials.
+
+Serves the DeepSeek chat-completions endpoint and the Safaricom OAuth and
+STK push endpoints on one port.
+
+Usage:
+    python stub_servers.py --port 8081 --latency 2 --fail-rate 0.1
+    DEEPSEEK_API_URL=http://127.0.0.1:8081/v1/chat/completions \
+    MPESA_API_URL=http://127.0.0.1:8081 python app.py
+"""
+import argparse
+import json
+import random
+import secrets
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real upstreams
+    latency = 0.0
+    fail_rate = 0.0
+    token_delay = 0.0
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def stream_completion(self, answer, usage=None):
+        """Send the answer word by word as chat-completion chunks, then usage if asked for"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        words = answer.split(' ')
+        for i, word in enumerate(words):
+            chunk = {"choices": [{"index": 0, "delta": {"content": word if i == 0 else ' ' + word}}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            time.sleep(self.token_delay)
+        if usage:
+            self.write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def should_fail(self):
+        """Sleep for the configured latency, then maybe inject a 503"""
+        time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            self.send_json(503, {"error": "Injected failure"})
+            return True
+        return False
+
+    def do_GET(self):
+        if self.path.startswith('/oauth/v1/generate'):
+            if self.should_fail():
+                return
+            self.send_json(200, {"access_token": secrets.token_hex(16), "expires_in": "3599"})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path == '/v1/chat/completions':
+            payload = self.read_json()
+            if self.should_fail():
+                return
+            prompt = payload['messages'][0]['content']
+            if isinstance(prompt, list):
+                prompt = prompt[0]['text']
+            answer = f"Stub answer for: {prompt[-80:]}"
+            # Rough counts, about four characters per token
+            usage = {"prompt_tokens": len(prompt) // 4 + 1, "completion_tokens": len(answer) // 4 + 1}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            if payload.get('stream'):
+                include_usage = (payload.get('stream_options') or {}).get('include_usage')
+                self.stream_completion(answer, usage if include_usage else None)
+                return
+            self.send_json(200, {
+                "id": "stub",
+                "object": "chat.completion",
+                "model": payload.get('model'),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+        elif self.path == '/mpesa/stkpush/v1/processrequest':
+            self.read_json()
+            if self.should_fail():
+                return
+            self.send_json(200, {
+                "MerchantRequestID": f"stub-{secrets.token_hex(6)}",
+                "CheckoutRequestID": f"ws_CO_{secrets.token_hex(8)}",
+                "ResponseCode": "0",
+                "ResponseDescription": "Success. Request accepted for processing",
+                "CustomerMessage": "Success. Request accepted for processing"
+            })
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections long before a benchmark saturates the app
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering')
+    parser.add_argument('--token-delay', type=float, default=0.05, help='Seconds between streamed tokens')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    StubHandler.fail_rate = args.fail_rate
+    StubHandler.token_delay = args.token_delay
+    server = StubServer((args.host, args.port), StubHandler)
+    print(f"Stub upstreams listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()